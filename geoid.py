@@ -0,0 +1,150 @@
+"""
+Geoid undulation (height of the geoid above the WGS-84 ellipsoid) from a compact binary grid,
+used to convert between height above mean sea level and WGS-84 ellipsoidal height:
+
+    ellipsoidal height = MSL height + N(lat, lon)
+
+Grid file layout (little-endian):
+    header      GRID_HEADER: magic, version, lat0, lon0, dlat, dlon, nlat, nlon
+    values      nlat * nlon int16 undulations in centimetres, row by row from lat0 northwards,
+                each row from lon0 eastwards
+
+The file is memory-mapped and interpolated bilinearly. Values are read per tile of TILE_SIZE x
+TILE_SIZE cells and the tiles of the recent area are memoized, so a lookup is a few microseconds.
+
+A real grid can be made from the NGA EGM96 15' grid (WW15MGH.GRD):
+    python geoid.py convert WW15MGH.GRD egm96_15.bin
+data/geoid_sample.bin is a small synthetic grid over Scandinavia for offline testing only,
+its values are NOT a geoid model:
+    python geoid.py sample data/geoid_sample.bin
+"""
+import array
+import functools
+import math
+import mmap
+import struct
+import sys
+
+GRID_MAGIC = b"GEOI"
+GRID_VERSION = 1
+GRID_HEADER = struct.Struct("<4sIddddII")
+VALUE_SCALE = 0.01  # [m] per stored unit
+TILE_SIZE = 16
+TILE_CACHE_SIZE = 64
+
+
+class GeoidModel:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as grid_file:
+            self._mapped = mmap.mmap(grid_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, lat0, lon0, dlat, dlon, nlat, nlon = GRID_HEADER.unpack_from(self._mapped, 0)
+        if magic != GRID_MAGIC or version != GRID_VERSION:
+            raise Exception(f"not a geoid grid file: {path}")
+        self.lat0, self.lon0, self.dlat, self.dlon = lat0, lon0, dlat, dlon
+        self.nlat, self.nlon = nlat, nlon
+        self.values = memoryview(self._mapped)[GRID_HEADER.size : GRID_HEADER.size + 2 * nlat * nlon].cast("h")
+        # a grid spanning all longitudes wraps around, regional grids do not
+        self.wraps = (nlon - 1) * dlon >= 360.0 - 1e-9
+        self._tile = functools.lru_cache(maxsize=TILE_CACHE_SIZE)(self._load_tile)
+
+    def _load_tile(self, tile_i: int, tile_j: int) -> tuple:
+        """Undulations [m] of the (TILE_SIZE + 1)^2 grid nodes of one tile, row by row"""
+        nodes = []
+        values, nlon = self.values, self.nlon
+        for i in range(tile_i * TILE_SIZE, tile_i * TILE_SIZE + TILE_SIZE + 1):
+            i = min(i, self.nlat - 1)
+            for j in range(tile_j * TILE_SIZE, tile_j * TILE_SIZE + TILE_SIZE + 1):
+                j = j % nlon if self.wraps else min(j, nlon - 1)
+                nodes.append(values[i * nlon + j] * VALUE_SCALE)
+        return tuple(nodes)
+
+    def undulation(self, lat: float, lon: float) -> float:
+        """Geoid undulation N [m] at lat/lon [deg], or None outside the grid"""
+        y = (lat - self.lat0) / self.dlat
+        if self.wraps:
+            x = ((lon - self.lon0) % 360.0) / self.dlon
+        else:
+            x = (lon - self.lon0) / self.dlon
+            if x < 0 or x > self.nlon - 1:
+                return None
+        if y < 0 or y > self.nlat - 1:
+            return None
+
+        i, j = int(y), int(x)
+        fy, fx = y - i, x - j
+        tile_i, row = divmod(i, TILE_SIZE)
+        tile_j, col = divmod(j, TILE_SIZE)
+        nodes = self._tile(tile_i, tile_j)
+        stride = TILE_SIZE + 1
+        k = row * stride + col
+        south = nodes[k] + (nodes[k + 1] - nodes[k]) * fx
+        north = nodes[k + stride] + (nodes[k + stride + 1] - nodes[k + stride]) * fx
+        return south + (north - south) * fy
+
+    def msl_to_ellipsoidal(self, height_msl_m: float, lat: float, lon: float) -> float:
+        """WGS-84 ellipsoidal height [m] from height above MSL [m], unchanged outside the grid"""
+        undulation = self.undulation(lat, lon)
+        return height_msl_m if undulation is None else height_msl_m + undulation
+
+    def ellipsoidal_to_msl(self, height_ellipsoidal_m: float, lat: float, lon: float) -> float:
+        """Height above MSL [m] from WGS-84 ellipsoidal height [m], unchanged outside the grid"""
+        undulation = self.undulation(lat, lon)
+        return height_ellipsoidal_m if undulation is None else height_ellipsoidal_m - undulation
+
+    def close(self) -> None:
+        self._tile.cache_clear()
+        self.values.release()
+        self._mapped.close()
+
+
+def write_grid(path: str, lat0: float, lon0: float, dlat: float, dlon: float, rows: list) -> None:
+    """Write a grid file. rows[i][j] is the undulation [m] at lat0 + i*dlat, lon0 + j*dlon."""
+    nlat, nlon = len(rows), len(rows[0])
+    values = array.array("h", (int(round(value / VALUE_SCALE)) for row in rows for value in row))
+    if sys.byteorder != "little":
+        values.byteswap()
+    with open(path, "wb") as grid_file:
+        grid_file.write(GRID_HEADER.pack(GRID_MAGIC, GRID_VERSION, lat0, lon0, dlat, dlon, nlat, nlon))
+        values.tofile(grid_file)
+
+
+def convert_grd(src: str, dst: str) -> None:
+    """Convert an NGA .GRD text grid (e.g. EGM96 WW15MGH.GRD) to the binary grid format.
+
+    The .GRD header is 'south north west east dlat dlon' in degrees, followed by the undulations
+    [m] row by row from north to south, each row from west to east.
+    """
+    with open(src) as grd_file:
+        numbers = [float(token) for token in grd_file.read().split()]
+    south, north, west, east, dlat, dlon = numbers[:6]
+    nlat = int(round((north - south) / dlat)) + 1
+    nlon = int(round((east - west) / dlon)) + 1
+    values = numbers[6:]
+    if len(values) != nlat * nlon:
+        raise Exception(f"expected {nlat * nlon} values in {src}, found {len(values)}")
+    rows_north_to_south = [values[i * nlon : (i + 1) * nlon] for i in range(nlat)]
+    write_grid(dst, south, west, dlat, dlon, rows_north_to_south[::-1])
+
+
+def write_sample_grid(path: str) -> None:
+    """Synthetic 1 degree grid over 50..72N, 0..32E with smooth made-up values, for testing only"""
+    rows = []
+    for i in range(23):
+        lat = 50.0 + i
+        rows.append(
+            [20.0 + 15.0 * math.sin(math.radians(lat * 6)) * math.cos(math.radians((0.0 + j) * 8)) for j in range(33)]
+        )
+    write_grid(path, 50.0, 0.0, 1.0, 1.0, rows)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "convert":
+        convert_grd(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) == 3 and sys.argv[1] == "sample":
+        write_sample_grid(sys.argv[2])
+    elif len(sys.argv) == 4:
+        model = GeoidModel(sys.argv[1])
+        print(model.undulation(float(sys.argv[2]), float(sys.argv[3])))
+    else:
+        print("usage: python geoid.py convert <src.GRD> <dst.bin> | sample <dst.bin> | <grid.bin> <lat> <lon>")
@@ -0,0 +1,543 @@
+"""
+Closed-loop load harness for the traffic injector and the user flight feeder.
+
+The real injector_process and user_flight_feeder_main are started against a synthetic Narsim
+TCP server and an in-process fake SimConnect, so the whole loop runs headless on Linux:
+
+    synthetic Narsim --NLROut truth--> injector_process --SetDataOnSimObject--> fake SimConnect
+    fake SimConnect --AircraftRequests--> user_flight_feeder_main --NLRIn truth--> synthetic Narsim
+
+Each load step (N flights at a given update rate) runs in its own worker process, since neither
+main loop can be stopped from the outside. For every step the harness reports end-to-end latency
+(generation -> AICreateNonATCAircraft/SetDataOnSimObject), CPU of the injector and feeder threads,
+RSS of the worker and the number of generated updates that never reached the simulator.
+
+usage: python load_harness.py --flights 10,50,100,200 --rate 1 --duration 20
+"""
+import argparse
+import ctypes
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import types
+from multiprocessing import shared_memory
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+NARSIM_TRUTH_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '    <NLROut source="NARSIM" xmlns:sti="http://www.w3.org/2001/XMLSchema-instance"><truth>'
+    "<callsign>{callsign}</callsign><toa>{toa:.6f}</toa><ssr_s>{ssr_s}</ssr_s><ssr_c>{ssr_c}</ssr_c><ssr_a>1200</ssr_a>"
+    '<lat unit="rad">{lat:.9f}</lat><lon unit="rad">{lon:.9f}</lon><height unit="m">{height:.6f}</height>'
+    '<alt unit="m">{alt:.6f}</alt><gspd unit="ms">{gspd:.6f}</gspd><crs unit="rad">{crs:.6f}</crs>'
+    '<v_rate unit="ms">0.000000</v_rate><turn_rate unit="">0.000000</turn_rate><long_acc unit="">0.000000</long_acc>'
+    '<v_acc unit="">0.000000</v_acc><pitch unit="">0.000000</pitch><bank unit="">0.000000</bank></truth></NLROut>\n'
+)
+EARTH_RADIUS_M = 6371000.0
+# synthetic traffic is spread around ESSA
+CENTER_LAT_RAD = math.radians(59.65)
+CENTER_LON_RAD = math.radians(17.92)
+
+
+class DeliveryLog:
+    """Matches what the fake simulator receives with what the synthetic Narsim generated.
+
+    Every generated update has a unique (lat, lon) pair, which is carried unchanged into the
+    SIMCONNECT_DATA_INITPOSITION struct by the injector, so it identifies the update end to end.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # (lat, lon) -> generation time
+        self.generated = 0
+        self.delivered = 0
+        self.latencies = []
+        self.measure_from = float("inf")
+
+    def generated_update(self, lat: float, lon: float, gen_time: float) -> None:
+        with self.lock:
+            self.pending[(lat, lon)] = gen_time
+            if gen_time >= self.measure_from:
+                self.generated += 1
+
+    def delivered_update(self, lat: float, lon: float, dispatch_time: float) -> None:
+        with self.lock:
+            gen_time = self.pending.pop((lat, lon), None)
+            if gen_time is not None and gen_time >= self.measure_from:
+                self.delivered += 1
+                self.latencies.append(dispatch_time - gen_time)
+
+    def start_measuring(self, start_time: float) -> None:
+        with self.lock:
+            self.measure_from = start_time
+            self.pending = {key: t for key, t in self.pending.items() if t >= start_time}
+
+
+# ---- fake SimConnect ----
+
+
+class SIMCONNECT_DATA_INITPOSITION(ctypes.Structure):
+    _fields_ = [
+        ("Latitude", ctypes.c_double),
+        ("Longitude", ctypes.c_double),
+        ("Altitude", ctypes.c_double),
+        ("Pitch", ctypes.c_double),
+        ("Bank", ctypes.c_double),
+        ("Heading", ctypes.c_double),
+        ("OnGround", ctypes.c_uint32),
+        ("Airspeed", ctypes.c_uint32),
+    ]
+
+
+class _DllFunction:
+    """Callable standing in for a SimConnect.dll function, with the ctypes prototype lookup
+    the injector uses to get the SIMCONNECT_DATA_INITPOSITION class"""
+
+    def __init__(self, func, argtypes=()):
+        self.func = func
+        self.argtypes = list(argtypes)
+
+    def __call__(self, *args):
+        return self.func(*args)
+
+    def __ctypes_from_outparam__(self):
+        return self
+
+
+class FakeSimConnectDll:
+    def __init__(self, delivery_log: DeliveryLog):
+        self.delivery_log = delivery_log
+        self.lock = threading.Lock()
+        self.next_object_id = 1000
+        self.objects = set()
+        self.calls = {"create": 0, "set_data": 0, "remove": 0}
+        self.AICreateNonATCAircraft = _DllFunction(
+            self._create, (None, None, None, SIMCONNECT_DATA_INITPOSITION, None)
+        )
+        self.SetDataOnSimObject = _DllFunction(self._set_data)
+        self.AIRemoveObject = _DllFunction(self._remove)
+        self.AddToDataDefinition = _DllFunction(lambda *args: 0)
+
+    def _create(self, handle, model_title, tail_number, init_position, req_id):
+        now = time.time()
+        with self.lock:
+            object_id = self.next_object_id
+            self.next_object_id += 1
+            self.objects.add(object_id)
+            self.calls["create"] += 1
+        # python-SimConnect publishes the id of the created object through the environment
+        os.environ["SIMCONNECT_OBJECT_ID"] = str(object_id)
+        self.delivery_log.delivered_update(init_position.Latitude, init_position.Longitude, now)
+        return 0
+
+    def _set_data(self, handle, define_id, object_id, flags, array_count, size, data_pointer):
+        now = time.time()
+        position = data_pointer.contents
+        with self.lock:
+            self.calls["set_data"] += 1
+        self.delivery_log.delivered_update(position.Latitude, position.Longitude, now)
+        return 0
+
+    def _remove(self, handle, object_id, req_id):
+        with self.lock:
+            self.objects.discard(object_id)
+            self.calls["remove"] += 1
+        return 0
+
+
+class _Id:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeSimConnect:
+    """Stands in for SimConnect.SimConnect, both for the injector (dll calls) and the feeder"""
+
+    def __init__(self, delivery_log: DeliveryLog = None, auto_connect: bool = True):
+        self.hSimConnect = 1
+        self.dll = FakeSimConnectDll(delivery_log or DeliveryLog())
+        self._request_id = 0
+        self._def_id = 0
+
+    def new_request_id(self):
+        self._request_id += 1
+        return self._request_id
+
+    def new_def_id(self):
+        self._def_id += 1
+        return _Id(self._def_id)
+
+    def IsHR(self, hr, value):
+        return hr == value
+
+
+class FakeOwnship:
+    """User aircraft flying a circle around ESSA, in the units SimConnect reports them"""
+
+    def __init__(self):
+        self.start_time = time.time()
+
+    def value(self, name: str) -> float:
+        t = time.time() - self.start_time
+        angle = t * 0.01
+        values = {
+            "PLANE_LATITUDE": 59.65 + 0.2 * math.sin(angle),
+            "PLANE_LONGITUDE": 17.92 + 0.4 * math.cos(angle),
+            "PLANE_ALTITUDE": 5000.0,
+            "GROUND_VELOCITY": 250.0,
+            "PLANE_HEADING_DEGREES_TRUE": (angle + math.pi / 2) % (2 * math.pi),
+            "VERTICAL_SPEED": 0.0,
+            "ROTATION_VELOCITY_BODY_Y": 0.6,
+            "ACCELERATION_BODY_Z": 0.0,
+            "ACCELERATION_BODY_Y": 0.0,
+            "PLANE_PITCH_DEGREES": 0.0,
+            "PLANE_BANK_DEGREES": 0.1,
+            "PRESSURE_ALTITUDE": 1524.0,
+        }
+        return values.get(name, 0.0)
+
+
+class FakeAircraftRequests:
+    def __init__(self, sim_con, ownship: FakeOwnship = None):
+        self.ownship = ownship or FakeOwnship()
+
+    def find(self, name: str):
+        ownship = self.ownship
+        return types.SimpleNamespace(get=lambda: ownship.value(name))
+
+
+def install_fake_simconnect() -> None:
+    """Register fake SimConnect, SimConnect.Enum and SimConnect.Constants modules, providing
+    the names traffic_injector.py and user_flight_feeder.py import from the real package"""
+    package = types.ModuleType("SimConnect")
+    package.SimConnect = FakeSimConnect
+    package.AircraftRequests = FakeAircraftRequests
+    package.c_double = ctypes.c_double
+    package.c_char_p = ctypes.c_char_p
+    package.DWORD = ctypes.c_uint32
+    package.pointer = ctypes.pointer
+    package.sizeof = ctypes.sizeof
+    package.__all__ = ["SimConnect", "AircraftRequests", "c_double", "c_char_p", "DWORD", "pointer", "sizeof"]
+
+    enum_module = types.ModuleType("SimConnect.Enum")
+    enum_module.SIMCONNECT_DATATYPE = types.SimpleNamespace(SIMCONNECT_DATATYPE_INITPOSITION=0)
+    constants_module = types.ModuleType("SimConnect.Constants")
+    constants_module.SIMCONNECT_UNUSED = 0xFFFFFFFF
+
+    package.Enum = enum_module
+    package.Constants = constants_module
+    sys.modules["SimConnect"] = package
+    sys.modules["SimConnect.Enum"] = enum_module
+    sys.modules["SimConnect.Constants"] = constants_module
+
+
+# ---- synthetic Narsim ----
+
+
+class SyntheticNarsimServer:
+    """TCP server that sends NLROut truth messages for N moving flights at a fixed rate and
+    counts the NLRIn truth messages it receives. Clients that send NLRIn (the feeder) do not
+    get traffic, everyone else does."""
+
+    def __init__(self, n_flights: int, rate: float, delivery_log: DeliveryLog, host: str = "127.0.0.1"):
+        self.n_flights = n_flights
+        self.rate = rate
+        self.delivery_log = delivery_log
+        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_sock.bind((host, 0))
+        self.server_sock.listen()
+        self.address = self.server_sock.getsockname()
+        self.traffic_clients = []
+        self.clients_lock = threading.Lock()
+        self.generating = True
+        self.received_truth_msgs = 0
+        self.send_errors = 0
+
+        self.flights = []
+        for i in range(n_flights):
+            bearing = 2 * math.pi * i / max(n_flights, 1)
+            distance = 5000.0 + 150000.0 * ((i * 7919) % 1000) / 1000
+            self.flights.append(
+                {
+                    "callsign": f"SYN{i:04d}",
+                    "ssr_s": 600000 + i,
+                    "lat": CENTER_LAT_RAD + distance * math.cos(bearing) / EARTH_RADIUS_M,
+                    "lon": CENTER_LON_RAD + distance * math.sin(bearing) / EARTH_RADIUS_M / math.cos(CENTER_LAT_RAD),
+                    "alt": 600.0 + (i % 40) * 300.0,
+                    "gspd": 80.0 + (i % 20) * 10.0,
+                    "crs": (bearing + math.pi / 2) % (2 * math.pi),
+                }
+            )
+
+    def start(self) -> None:
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        threading.Thread(target=self._generate_loop, daemon=True).start()
+
+    def _accept_loop(self) -> None:
+        while True:
+            client, _ = self.server_sock.accept()
+            with self.clients_lock:
+                self.traffic_clients.append(client)
+            threading.Thread(target=self._read_loop, args=(client,), daemon=True).start()
+
+    def _read_loop(self, client: socket.socket) -> None:
+        pending = ""
+        while True:
+            try:
+                data = client.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            with self.clients_lock:
+                if client in self.traffic_clients:
+                    self.traffic_clients.remove(client)
+            pending += data.decode(errors="replace")
+            self.received_truth_msgs += pending.count("</NLRIn>")
+            pending = pending[pending.rfind("</NLRIn>") + len("</NLRIn>") :] if "</NLRIn>" in pending else pending
+
+    def _generate_loop(self) -> None:
+        interval = 1 / self.rate
+        next_tick = time.time()
+        while self.generating:
+            now = time.time()
+            messages = []
+            for flight in self.flights:
+                distance = flight["gspd"] * interval
+                flight["lat"] += distance * math.cos(flight["crs"]) / EARTH_RADIUS_M
+                flight["lon"] += distance * math.sin(flight["crs"]) / EARTH_RADIUS_M / math.cos(flight["lat"])
+                msg = NARSIM_TRUTH_TEMPLATE.format(
+                    toa=now,
+                    ssr_c=int(flight["alt"] * 3.2808399 / 100),
+                    height=flight["alt"] + 30.0,
+                    **flight,
+                )
+                # the injector parses exactly the digits that were sent, so the key survives the round trip
+                self.delivery_log.generated_update(float(f"{flight['lat']:.9f}"), float(f"{flight['lon']:.9f}"), now)
+                messages.append(msg)
+            payload = "".join(messages).encode()
+            with self.clients_lock:
+                clients = list(self.traffic_clients)
+            for client in clients:
+                try:
+                    client.sendall(payload)
+                except OSError:
+                    self.send_errors += 1
+            next_tick += interval
+            time.sleep(max(0.0, next_tick - time.time()))
+
+
+# ---- measurement ----
+
+
+def thread_cpu_seconds(native_id: int) -> float:
+    """CPU time (user + system) of one thread of this process, Linux only"""
+    try:
+        with open(f"/proc/self/task/{native_id}/stat") as stat_file:
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    # fields[0] is the state (field 3 in proc(5)), utime and stime are fields 14 and 15
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def rss_megabytes() -> float:
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def run_worker(n_flights: int, rate: float, warmup: float, duration: float, drain: float, lod: bool = False) -> dict:
+    """Run one load step in this process and return its measurements"""
+    os.chdir(REPO_DIR)
+    sys.path.insert(0, REPO_DIR)
+    install_fake_simconnect()
+
+    delivery_log = DeliveryLog()
+    server = SyntheticNarsimServer(n_flights, rate, delivery_log)
+    server.start()
+
+    import traffic_injector
+    import user_flight_feeder
+
+    traffic_injector.SEND_DATA_TO_MSFS = True
+    traffic_injector.ENABLE_LOD_SCHEDULER = lod
+    user_flight_feeder.SEND_DATA_TO_NARSIM = True
+    user_flight_feeder.NARSIM_IP, user_flight_feeder.NARSIM_PORT = server.address
+    # do not share the ownship segment with a feeder running on this machine
+    ownship_shm_name = f"load_harness_{os.getpid()}"
+    user_flight_feeder.OWNSHIP_SHM_NAME = traffic_injector.OWNSHIP_SHM_NAME = ownship_shm_name
+
+    thread_ids = {}
+    errors = []
+
+    def run(name, target, *args):
+        thread_ids[name] = threading.get_native_id()
+        try:
+            target(*args)
+        except BaseException as err:
+            errors.append(f"{name}: {type(err).__name__}: {err}")
+
+    injector_sock = socket.create_connection(server.address)
+    sim_con = FakeSimConnect(delivery_log)
+    threading.Thread(
+        target=run, args=("injector", traffic_injector.injector_process, sim_con, injector_sock), daemon=True
+    ).start()
+    threading.Thread(target=run, args=("feeder", user_flight_feeder.user_flight_feeder_main), daemon=True).start()
+
+    time.sleep(warmup)
+    start_time = time.time()
+    delivery_log.start_measuring(start_time)
+    feeder_msgs_start = server.received_truth_msgs
+    cpu_start = {name: thread_cpu_seconds(tid) for name, tid in thread_ids.items()}
+    process_cpu_start = time.process_time()
+
+    time.sleep(duration)
+    server.generating = False
+    end_time = time.time()
+    cpu_end = {name: thread_cpu_seconds(tid) for name, tid in thread_ids.items()}
+    process_cpu_end = time.process_time()
+    feeder_msgs = server.received_truth_msgs - feeder_msgs_start
+    time.sleep(drain)
+
+    # the feeder loop never returns, so its ownship segment is removed here
+    try:
+        ownship_segment = shared_memory.SharedMemory(name=ownship_shm_name)
+        ownship_segment.close()
+        ownship_segment.unlink()
+    except FileNotFoundError:
+        pass
+
+    with delivery_log.lock:
+        generated = delivery_log.generated
+        delivered = delivery_log.delivered
+        latencies = list(delivery_log.latencies)
+    elapsed = end_time - start_time
+    cpu_pct = {}
+    for name in thread_ids:
+        if cpu_start.get(name) is None or cpu_end.get(name) is None:
+            cpu_pct[name] = None
+        else:
+            cpu_pct[name] = 100 * (cpu_end[name] - cpu_start[name]) / elapsed
+    p50, p90, p99 = traffic_injector.percentiles(latencies)
+    return {
+        "flights": n_flights,
+        "rate": rate,
+        "offered_per_s": generated / elapsed,
+        "delivered_per_s": delivered / elapsed,
+        "generated": generated,
+        "delivered": delivered,
+        "dropped": generated - delivered,
+        "dropped_pct": 100 * (generated - delivered) / generated if generated else 0.0,
+        "latency_p50_ms": None if p50 is None else 1000 * p50,
+        "latency_p90_ms": None if p90 is None else 1000 * p90,
+        "latency_p99_ms": None if p99 is None else 1000 * p99,
+        "latency_max_ms": 1000 * max(latencies) if latencies else None,
+        "cpu_injector_pct": cpu_pct.get("injector"),
+        "cpu_feeder_pct": cpu_pct.get("feeder"),
+        "cpu_process_pct": 100 * (process_cpu_end - process_cpu_start) / elapsed,
+        "rss_mb": rss_megabytes(),
+        "feeder_msgs_per_s": feeder_msgs / elapsed,
+        "sim_calls": dict(sim_con.dll.calls),
+        "errors": errors,
+    }
+
+
+def run_step(n_flights: int, args: argparse.Namespace) -> dict:
+    """Run one load step in a fresh worker process"""
+    command = [
+        sys.executable,
+        os.path.abspath(__file__),
+        "--worker",
+        "--flights", str(n_flights),
+        "--rate", str(args.rate),
+        "--warmup", str(args.warmup),
+        "--duration", str(args.duration),
+        "--drain", str(args.drain),
+    ]
+    if args.lod:
+        command.append("--lod")
+    timeout = args.warmup + args.duration + args.drain + 60
+    completed = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode != 0 or not lines:
+        raise Exception(f"load step with {n_flights} flights failed:\n{completed.stderr}")
+    return json.loads(lines[-1])
+
+
+def _fmt(value, spec: str) -> str:
+    return "-" if value is None else format(value, spec)
+
+
+def print_saturation_curve(results: list[dict], max_dropped_pct: float, max_p99_ms: float) -> None:
+    print("flights  offered/s  delivered/s  dropped%  p50ms   p90ms   p99ms   cpu_inj%  cpu_feed%  rss_MB  feeder/s")
+    saturated_at = None
+    for r in results:
+        print(
+            f"{r['flights']:7d}  {r['offered_per_s']:9.1f}  {r['delivered_per_s']:11.1f}  {r['dropped_pct']:8.1f}"
+            f"  {_fmt(r['latency_p50_ms'], '6.1f')}  {_fmt(r['latency_p90_ms'], '6.1f')}  {_fmt(r['latency_p99_ms'], '6.1f')}"
+            f"  {_fmt(r['cpu_injector_pct'], '8.1f')}  {_fmt(r['cpu_feeder_pct'], '9.1f')}  {_fmt(r['rss_mb'], '6.1f')}"
+            f"  {r['feeder_msgs_per_s']:8.2f}"
+        )
+        for error in r["errors"]:
+            print(f"         error: {error}")
+        over_latency = r["latency_p99_ms"] is None or r["latency_p99_ms"] > max_p99_ms
+        if saturated_at is None and (r["dropped_pct"] > max_dropped_pct or over_latency):
+            saturated_at = r["flights"]
+    if saturated_at is None:
+        print(f"not saturated up to {results[-1]['flights']} flights")
+    else:
+        print(f"saturated at {saturated_at} flights (dropped > {max_dropped_pct}% or p99 > {max_p99_ms} ms)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--flights", default="5,10,20,50,100", help="comma separated ramp of flight counts")
+    parser.add_argument("--rate", type=float, default=1.0, help="Narsim update rate per flight [Hz]")
+    parser.add_argument("--warmup", type=float, default=10.0, help="seconds before measuring, flights are created here")
+    parser.add_argument("--duration", type=float, default=20.0, help="measured seconds per step")
+    parser.add_argument("--drain", type=float, default=3.0, help="seconds to wait for in-flight updates after generation stops")
+    parser.add_argument("--max-dropped-pct", type=float, default=1.0, help="saturation criterion")
+    parser.add_argument("--max-p99-ms", type=float, default=1000.0, help="saturation criterion")
+    parser.add_argument(
+        "--lod",
+        action="store_true",
+        help="enable the LOD update scheduler, coalesced updates are then counted as dropped",
+    )
+    parser.add_argument("--output", help="write all step results as JSON to this file")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # the processes print every message, keep the real stdout for the result only
+        result_fd = os.dup(1)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        result = run_worker(int(args.flights), args.rate, args.warmup, args.duration, args.drain, args.lod)
+        os.write(result_fd, (json.dumps(result) + "\n").encode())
+        # the injector and feeder loops never return
+        os._exit(0)
+
+    results = []
+    for n_flights in [int(n) for n in args.flights.split(",")]:
+        print(f"running {n_flights} flights at {args.rate} Hz...", flush=True)
+        results.append(run_step(n_flights, args))
+    print_saturation_curve(results, args.max_dropped_pct, args.max_p99_ms)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Shared-memory channel carrying the latest ownship (user aircraft) sample from the user flight
+feeder to the traffic injector, or any other local tool, without extra SimConnect requests.
+
+The segment holds one sample protected by a seqlock:
+    offset 0    uint64 sequence number, odd while the writer is updating the sample
+    offset 8    float64 fields in OWNSHIP_FIELDS order
+
+There is a single writer (the feeder). Readers never block it: they read the sequence number,
+the fields and the sequence number again, and retry if it was odd or has changed.
+
+A restarted feeder creates a new segment under the same name (on POSIX the old one is unlinked), so
+a reader that has not seen the sequence number change for REATTACH_INTERVAL seconds attaches again.
+
+Units: toa [s since epoch], lat/lon [deg], alt/height [ft], gspd [kts], crs [deg], v_rate [m/s],
+turn_rate [rad/s], pitch and bank [rad], the same as in the trajectory archive.
+"""
+import collections
+import os
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+OWNSHIP_FIELDS = ("toa", "lat", "lon", "alt", "height", "gspd", "crs", "v_rate", "turn_rate", "pitch", "bank")
+SEQ_SIZE = 8
+SEGMENT_SIZE = SEQ_SIZE + 8 * len(OWNSHIP_FIELDS)
+MAX_READ_ATTEMPTS = 100
+REATTACH_INTERVAL = 2.0  # [s]
+
+OwnshipSample = collections.namedtuple("OwnshipSample", OWNSHIP_FIELDS)
+
+
+def _untrack(shm: shared_memory.SharedMemory) -> None:
+    """Keep the POSIX resource tracker from unlinking a segment this process did not create"""
+    if os.name == "posix":
+        resource_tracker.unregister(shm._name, "shared_memory")
+
+
+def _track(shm: shared_memory.SharedMemory) -> None:
+    """Register the segment again before unlinking it, a reader in the same process
+    (e.g. the load harness) may have unregistered it"""
+    if os.name == "posix":
+        resource_tracker.register(shm._name, "shared_memory")
+
+
+class OwnshipPublisher:
+    """Writer side, owned by the user flight feeder"""
+
+    def __init__(self, name: str):
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=SEGMENT_SIZE)
+            self.created = True
+        except FileExistsError:
+            # left over from a previous run that was not shut down cleanly
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.created = False
+            _untrack(self.shm)
+        self.seq = self.shm.buf[:SEQ_SIZE].cast("Q")
+        self.fields = self.shm.buf[SEQ_SIZE:SEGMENT_SIZE].cast("d")
+        self.seq[0] = 0
+
+    def publish(self, sample: dict) -> None:
+        """Publish one sample, a dict with the keys in OWNSHIP_FIELDS"""
+        seq = self.seq[0] + 1
+        self.seq[0] = seq  # odd: update in progress
+        fields = self.fields
+        for i, name in enumerate(OWNSHIP_FIELDS):
+            fields[i] = sample[name]
+        self.seq[0] = seq + 1
+
+    def close(self) -> None:
+        self.seq.release()
+        self.fields.release()
+        self.shm.close()
+        if self.created:
+            _track(self.shm)
+            self.shm.unlink()
+
+
+class OwnshipReader:
+    """Reader side. Attaches lazily, so it can be created before the feeder is running."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.shm = None
+        self.seq = None
+        self.fields = None
+        self.retries = 0
+        self.reattaches = 0
+        self.last_seq = None
+        self.last_seq_change_time = None
+
+    def _attach(self) -> bool:
+        try:
+            self.shm = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return False
+        _untrack(self.shm)
+        self.seq = self.shm.buf[:SEQ_SIZE].cast("Q")
+        self.fields = self.shm.buf[SEQ_SIZE:SEGMENT_SIZE].cast("d")
+        self.last_seq = None
+        self.last_seq_change_time = time.monotonic()
+        return True
+
+    def _check_segment(self) -> bool:
+        """Attach again if no new sample was published for REATTACH_INTERVAL seconds, the feeder may
+        have been restarted with a new segment. Returns False if no segment is available."""
+        now = time.monotonic()
+        current_seq = self.seq[0]
+        if current_seq != self.last_seq:
+            self.last_seq = current_seq
+            self.last_seq_change_time = now
+            return True
+        if now - self.last_seq_change_time < REATTACH_INTERVAL:
+            return True
+        self.close()
+        self.reattaches += 1
+        return self._attach()
+
+    def read(self) -> OwnshipSample:
+        """Latest ownship sample, or None if the feeder has not published anything yet"""
+        if self.shm is None and not self._attach():
+            return None
+        if not self._check_segment():
+            return None
+        seq, fields = self.seq, self.fields
+        for _ in range(MAX_READ_ATTEMPTS):
+            seq_before = seq[0]
+            if seq_before == 0:
+                return None
+            if seq_before & 1:
+                self.retries += 1
+                continue
+            sample = OwnshipSample(*fields)
+            if seq[0] == seq_before:
+                return sample
+            self.retries += 1
+        return None
+
+    def close(self) -> None:
+        if self.shm is None:
+            return
+        self.seq.release()
+        self.fields.release()
+        self.shm.close()
+        self.shm = None
@@ -0,0 +1,135 @@
+"""
+Opt-in span tracing for the traffic injector and the user flight feeder.
+
+Spans are kept in a fixed-size in-memory ring and can be written as Chrome trace / Perfetto
+JSON (open in chrome://tracing or https://ui.perfetto.dev) on demand with Tracer.dump, or by
+sending the process SIGUSR1 (Ctrl+Break on Windows) after install_dump_signal.
+
+Timestamps are taken from perf_counter and shifted to the Unix epoch, so traces dumped by the
+injector and the feeder can be loaded together and share one timeline.
+"""
+import collections
+import json
+import os
+import signal
+import threading
+import time
+
+
+class _NullSpan:
+    """Returned by a disabled tracer, so tracing costs one method call and no allocation"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **args) -> None:
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("ring", "name", "args", "start")
+
+    def __init__(self, ring: collections.deque, name: str, args: dict):
+        self.ring = ring
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        # deque.append is atomic, spans from several threads can share the ring
+        self.ring.append((self.name, self.start, end - self.start, threading.get_ident(), self.args))
+        return False
+
+    def set(self, **args) -> None:
+        """Add tags that are only known inside the span, e.g. the callsign after decoding"""
+        self.args.update(args)
+
+
+class Tracer:
+    def __init__(self, enabled: bool = False, ring_size: int = 200000, process_name: str = "msfs-narsim-client"):
+        self.enabled = enabled
+        self.process_name = process_name
+        self.ring = collections.deque(maxlen=ring_size)
+        self.epoch_offset_ns = time.time_ns() - time.perf_counter_ns()
+
+    def span(self, name: str, **args):
+        """Context manager recording one span, e.g.
+
+            with tracer.span("update", callsign=callsign):
+                update_pos_msfs_aircraft(...)
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self.ring, name, args)
+
+    def chrome_trace(self) -> dict:
+        """Spans in the ring as a Chrome trace event dict"""
+        pid = os.getpid()
+        events = [
+            {"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": self.process_name}},
+        ]
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for tid in {span[3] for span in self.ring}:
+            events.append(
+                {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread_names.get(tid, str(tid))}}
+            )
+        for name, start, duration, tid, args in list(self.ring):
+            events.append(
+                {
+                    "name": name,
+                    "cat": self.process_name,
+                    "ph": "X",
+                    "ts": (start + self.epoch_offset_ns) / 1000,
+                    "dur": duration / 1000,
+                    "pid": pid,
+                    "tid": tid,
+                    "args": args,
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path: str) -> str:
+        """Write the ring as Chrome trace JSON to 'path' and return the path"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
+        return path
+
+    def dump_to_dir(self, dump_dir: str) -> str:
+        """Write the ring to a timestamped file in 'dump_dir' and return its path"""
+        file_name = f"trace-{self.process_name}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+        return self.dump(os.path.join(dump_dir, file_name))
+
+
+def install_dump_signal(tracer: Tracer, dump_dir: str) -> bool:
+    """Dump the ring to 'dump_dir' when the process receives SIGUSR1, or SIGBREAK (Ctrl+Break)
+    on Windows. Signal handlers can only be installed from the main thread.
+
+    Returns:
+        bool: True if a handler was installed
+    """
+    signum = getattr(signal, "SIGUSR1", None) or getattr(signal, "SIGBREAK", None)
+    if signum is None or threading.current_thread() is not threading.main_thread():
+        return False
+
+    def dump_handler(signum, frame):
+        print(f"trace written to {tracer.dump_to_dir(dump_dir)}")
+
+    signal.signal(signum, dump_handler)
+    return True
@@ -0,0 +1,326 @@
+"""
+Republishes the decoded traffic picture of the injector to local subscribers (map display, logger,
+a second MSFS client, ...), so Narsim only has one client and the XML is only parsed once.
+
+Transports:
+    multicast   UDP datagrams to a multicast group. A full snapshot is sent every snapshot_interval
+                seconds, so subscribers that join late or lose a datagram catch up.
+    unix        Unix domain stream socket. A new subscriber first gets a snapshot, then deltas.
+                Subscribers that do not keep up are disconnected.
+
+Every frame is a FRAME_HEADER followed by 'count' fixed-size records:
+    SNAPSHOT    TRAFFIC_RECORD for every flight. FLAG_FIRST / FLAG_LAST mark the parts of a snapshot
+                that is split over several datagrams; FLAG_LAST ends the snapshot.
+    DELTA       TRAFFIC_RECORD for every flight that changed since the previous frame
+    REMOVE      CALLSIGN_RECORD for every flight that is gone
+
+Record units: toa [s], lat/lon [deg], alt/height [ft], gspd [kts], crs [deg], v_rate [m/s],
+turn_rate, pitch and bank as received from Narsim.
+"""
+import collections
+import os
+import select
+import socket
+import struct
+import time
+
+FRAME_MAGIC = b"NTFO"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("<4sBBHQdI")  # magic, version, msg_type, flags, seq, send_time, count
+MSG_SNAPSHOT = 1
+MSG_DELTA = 2
+MSG_REMOVE = 3
+FLAG_FIRST = 1
+FLAG_LAST = 2
+
+TRAFFIC_FIELDS = ("toa", "lat", "lon", "alt", "height", "gspd", "crs", "v_rate", "turn_rate", "pitch", "bank")
+TRAFFIC_RECORD = struct.Struct("<8s" + "d" * len(TRAFFIC_FIELDS))
+CALLSIGN_RECORD = struct.Struct("<8s")
+RECORD_SIZES = {MSG_SNAPSHOT: TRAFFIC_RECORD.size, MSG_DELTA: TRAFFIC_RECORD.size, MSG_REMOVE: CALLSIGN_RECORD.size}
+
+# keep datagrams below a typical Ethernet MTU
+MAX_DATAGRAM_SIZE = 1400
+# outgoing bytes buffered for one unix subscriber before it is disconnected
+MAX_SUBSCRIBER_BUFFER = 4 * 1024 * 1024
+
+TrafficRecord = collections.namedtuple("TrafficRecord", ("callsign",) + TRAFFIC_FIELDS)
+
+
+def encode_frames(msg_type: int, seq: int, records: list, max_size: int = None) -> list[bytes]:
+    """Encode records (packed with TRAFFIC_RECORD or CALLSIGN_RECORD) as one frame, or as several
+    frames of at most max_size bytes each"""
+    record_size = RECORD_SIZES[msg_type]
+    per_frame = len(records) or 1
+    if max_size is not None:
+        per_frame = max(1, (max_size - FRAME_HEADER.size) // record_size)
+    parts = [records[i : i + per_frame] for i in range(0, len(records), per_frame)] or [[]]
+    frames = []
+    now = time.time()
+    for i, part in enumerate(parts):
+        flags = (FLAG_FIRST if i == 0 else 0) | (FLAG_LAST if i == len(parts) - 1 else 0)
+        header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, msg_type, flags, seq, now, len(part))
+        frames.append(header + b"".join(part))
+    return frames
+
+
+def pack_traffic_record(callsign: str, record: dict) -> bytes:
+    return TRAFFIC_RECORD.pack(callsign.encode()[:8], *(float(record[field]) for field in TRAFFIC_FIELDS))
+
+
+def decode_frame(frame: bytes) -> tuple:
+    """Decode one complete frame.
+
+    Returns:
+        tuple: (msg_type, flags, seq, send_time, records), records are TrafficRecord for SNAPSHOT/DELTA
+               and callsign strings for REMOVE
+    """
+    magic, version, msg_type, flags, seq, send_time, count = FRAME_HEADER.unpack_from(frame, 0)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise Exception("not a traffic fan-out frame")
+    offset = FRAME_HEADER.size
+    records = []
+    if msg_type == MSG_REMOVE:
+        for (callsign,) in CALLSIGN_RECORD.iter_unpack(frame[offset : offset + count * CALLSIGN_RECORD.size]):
+            records.append(callsign.rstrip(b"\0").decode())
+    else:
+        for values in TRAFFIC_RECORD.iter_unpack(frame[offset : offset + count * TRAFFIC_RECORD.size]):
+            records.append(TrafficRecord(values[0].rstrip(b"\0").decode(), *values[1:]))
+    return msg_type, flags, seq, send_time, records
+
+
+def frame_size(header: bytes) -> int:
+    """Total size of a frame from its header"""
+    _, _, msg_type, _, _, _, count = FRAME_HEADER.unpack_from(header, 0)
+    return FRAME_HEADER.size + count * RECORD_SIZES[msg_type]
+
+
+class TrafficFanout:
+    """Publisher side, fed by NarsimFlightsProcessor"""
+
+    def __init__(
+        self,
+        transport: str,
+        multicast_group: str = "239.255.42.99",
+        multicast_port: int = 5684,
+        multicast_ttl: int = 1,
+        unix_socket_path: str = None,
+        snapshot_interval: float = 2.0,
+    ):
+        self.transport = transport
+        self.snapshot_interval = snapshot_interval
+        self.last_snapshot_time = 0.0
+        self.seq = 0
+        self.changed = set()
+        self.removed = set()
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.subscribers_dropped = 0
+
+        if transport == "multicast":
+            self.multicast_address = (multicast_group, multicast_port)
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        elif transport == "unix":
+            if not hasattr(socket, "AF_UNIX"):
+                raise Exception("unix sockets are not available on this platform, use multicast")
+            self.unix_socket_path = unix_socket_path
+            if os.path.exists(unix_socket_path):
+                os.unlink(unix_socket_path)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(unix_socket_path)
+            self.sock.listen()
+            self.sock.setblocking(False)
+            # subscriber socket -> outgoing bytes not yet accepted by the kernel
+            self.subscribers = {}
+        else:
+            raise Exception(f"unknown traffic fan-out transport: {transport}")
+
+    def mark_changed(self, callsign: str) -> None:
+        self.changed.add(callsign)
+        self.removed.discard(callsign)
+
+    def mark_removed(self, callsign: str) -> None:
+        self.removed.add(callsign)
+        self.changed.discard(callsign)
+
+    def _next_seq(self) -> int:
+        self.seq += 1
+        return self.seq
+
+    def _snapshot_frames(self, records: dict, seq: int, max_size: int = None) -> list[bytes]:
+        packed = [pack_traffic_record(callsign, record) for callsign, record in records.items()]
+        return encode_frames(MSG_SNAPSHOT, seq, packed, max_size)
+
+    def publish(self, records: dict, now: float = None) -> None:
+        """Send what changed since the last call.
+
+        Args:
+            records (dict): {callsign: record} with the keys in TRAFFIC_FIELDS, in record units
+            now (float, optional): current time. Defaults to time.time().
+        """
+        if now is None:
+            now = time.time()
+        max_size = MAX_DATAGRAM_SIZE if self.transport == "multicast" else None
+        frames = []
+        if self.removed:
+            packed = [CALLSIGN_RECORD.pack(callsign.encode()[:8]) for callsign in sorted(self.removed)]
+            frames.extend(encode_frames(MSG_REMOVE, self._next_seq(), packed, max_size))
+        if self.transport == "multicast" and now >= self.last_snapshot_time + self.snapshot_interval:
+            self.last_snapshot_time = now
+            frames.extend(self._snapshot_frames(records, self._next_seq(), max_size))
+        elif self.changed:
+            packed = [pack_traffic_record(callsign, records[callsign]) for callsign in sorted(self.changed) if callsign in records]
+            frames.extend(encode_frames(MSG_DELTA, self._next_seq(), packed, max_size))
+        self.changed.clear()
+        self.removed.clear()
+
+        if self.transport == "multicast":
+            for frame in frames:
+                self.sock.sendto(frame, self.multicast_address)
+                self.frames_sent += 1
+                self.bytes_sent += len(frame)
+        else:
+            data = b"".join(frames)
+            for subscriber in list(self.subscribers):
+                self._send_to_subscriber(subscriber, data, len(frames))
+            # after the deltas, so a new subscriber's snapshot already includes them
+            self._accept_subscribers(records)
+
+    def _accept_subscribers(self, records: dict) -> None:
+        while True:
+            try:
+                subscriber, _ = self.sock.accept()
+            except BlockingIOError:
+                return
+            subscriber.setblocking(False)
+            self.subscribers[subscriber] = bytearray()
+            # the snapshot carries the sequence number of the last frame sent to everyone, it does not
+            # take a new one, which the other subscribers would count as a gap
+            snapshot_frames = self._snapshot_frames(records, self.seq)
+            self._send_to_subscriber(subscriber, b"".join(snapshot_frames), len(snapshot_frames))
+
+    def _send_to_subscriber(self, subscriber: socket.socket, data: bytes, n_frames: int) -> None:
+        """Queue 'data', holding n_frames frames, for a subscriber and send as much as it accepts"""
+        pending = self.subscribers[subscriber]
+        pending += data
+        try:
+            while pending:
+                sent = subscriber.send(pending)
+                self.bytes_sent += sent
+                del pending[:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._drop_subscriber(subscriber)
+            return
+        if len(pending) > MAX_SUBSCRIBER_BUFFER:
+            self._drop_subscriber(subscriber)
+            return
+        self.frames_sent += n_frames
+
+    def _drop_subscriber(self, subscriber: socket.socket) -> None:
+        self.subscribers.pop(subscriber, None)
+        self.subscribers_dropped += 1
+        subscriber.close()
+
+    def n_subscribers(self) -> int:
+        return len(self.subscribers) if self.transport == "unix" else None
+
+    def close(self) -> None:
+        if self.transport == "unix":
+            for subscriber in list(self.subscribers):
+                subscriber.close()
+            self.subscribers.clear()
+            self.sock.close()
+            if os.path.exists(self.unix_socket_path):
+                os.unlink(self.unix_socket_path)
+        else:
+            self.sock.close()
+
+
+class TrafficSubscriber:
+    """Subscriber side, keeps the traffic picture in 'flights' ({callsign: TrafficRecord})"""
+
+    def __init__(
+        self,
+        transport: str,
+        multicast_group: str = "239.255.42.99",
+        multicast_port: int = 5684,
+        unix_socket_path: str = None,
+    ):
+        self.transport = transport
+        self.flights = {}
+        self.last_seq = None
+        self.gaps = 0
+        self.has_snapshot = False
+        self._snapshot = {}
+        self._buffer = bytearray()
+        if transport == "multicast":
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(("", multicast_port))
+            membership = struct.pack("=4s4s", socket.inet_aton(multicast_group), socket.inet_aton("0.0.0.0"))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        elif transport == "unix":
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(unix_socket_path)
+        else:
+            raise Exception(f"unknown traffic fan-out transport: {transport}")
+
+    def poll(self, timeout: float = 0.0) -> int:
+        """Apply all frames received within 'timeout' seconds, returns the number of frames applied"""
+        n_frames = 0
+        while select.select([self.sock], [], [], timeout)[0]:
+            timeout = 0.0
+            if self.transport == "multicast":
+                self.apply(self.sock.recv(65536))
+                n_frames += 1
+                continue
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("traffic fan-out publisher closed the connection")
+            self._buffer += data
+            while len(self._buffer) >= FRAME_HEADER.size and len(self._buffer) >= frame_size(self._buffer):
+                size = frame_size(self._buffer)
+                self.apply(bytes(self._buffer[:size]))
+                del self._buffer[:size]
+                n_frames += 1
+        return n_frames
+
+    def apply(self, frame: bytes) -> None:
+        msg_type, flags, seq, _, records = decode_frame(frame)
+        if self.last_seq is not None and seq > self.last_seq + 1:
+            self.gaps += 1
+        # the parts of a split snapshot share one sequence number
+        self.last_seq = seq
+        if msg_type == MSG_REMOVE:
+            for callsign in records:
+                self.flights.pop(callsign, None)
+            return
+        if msg_type == MSG_SNAPSHOT:
+            if flags & FLAG_FIRST:
+                self._snapshot = {}
+            self._snapshot.update((record.callsign, record) for record in records)
+            if flags & FLAG_LAST:
+                self.flights = self._snapshot
+                self._snapshot = {}
+                self.has_snapshot = True
+            return
+        for record in records:
+            self.flights[record.callsign] = record
+
+
+if __name__ == "__main__":
+    import sys
+
+    # usage: python traffic_fanout.py multicast [group port] | unix <path>
+    if len(sys.argv) >= 2 and sys.argv[1] == "unix":
+        subscriber = TrafficSubscriber("unix", unix_socket_path=sys.argv[2])
+    elif len(sys.argv) == 4:
+        subscriber = TrafficSubscriber("multicast", sys.argv[2], int(sys.argv[3]))
+    else:
+        subscriber = TrafficSubscriber("multicast")
+    while True:
+        subscriber.poll(timeout=1.0)
+        print(f"{len(subscriber.flights)} flights, gaps {subscriber.gaps}: {sorted(subscriber.flights)}")
@@ -6,14 +6,22 @@ import collections
 import os
 import configparser
 import signal
+import math
 
 from SimConnect import *
 from SimConnect.Enum import SIMCONNECT_DATATYPE
 from SimConnect.Constants import SIMCONNECT_UNUSED
 
+from trajectory_archive import TrajectoryArchiveWriter, new_session_dir
+from trace_spans import Tracer, install_dump_signal
+from ownship_channel import OwnshipReader, OwnshipSample
+from geoid import GeoidModel
+from traffic_fanout import TrafficFanout
+
 METER_TO_FEET = 3.2808399
 METER_PER_SECOND_TO_KNOTS = 1.94384449
 RAD_TO_DEG = 57.2957795
+EARTH_RADIUS_NM = 3440.065
 
 config = configparser.ConfigParser()
 config.read("./configuration.conf")
@@ -21,7 +29,88 @@ TIME_INTERVAL_INJECTOR = 1/float(config['traffic_injector']['UPDATE_FREQUENCY_IN
 # Set to False in config for debug with MSFS only
 SEND_DATA_TO_MSFS = config["traffic_injector"]["SEND_DATA_TO_MSFS"]
 SEND_DATA_TO_MSFS = SEND_DATA_TO_MSFS == "True"
-CONSOLE_LOGGING_TIME_INTERVAL = config["traffic_injector"]["CONSOLE_LOGGING_TIME_INTERVAL"]
+CONSOLE_LOGGING_TIME_INTERVAL = float(config["traffic_injector"]["CONSOLE_LOGGING_TIME_INTERVAL"])
+# each main loop iteration waits for Narsim data until the socket times out, then sleeps
+SOCKET_TIMEOUT = 0.2
+MAIN_LOOP_SLEEP = 0.10
+# number of latency samples kept per flight (and x10 for the aggregate) when reporting data age
+LATENCY_WINDOW = int(config["traffic_injector"].get("LATENCY_WINDOW", "200"))
+# Archive of decoded truth records, see trajectory_archive.py
+ENABLE_ARCHIVE = config["trajectory_archive"]["ENABLE_ARCHIVE"] == "True"
+ARCHIVE_DIR = config["trajectory_archive"]["ARCHIVE_DIR"]
+ARCHIVE_CHUNK_ROWS = int(config["trajectory_archive"]["CHUNK_ROWS"])
+ARCHIVE_FLUSH_INTERVAL = float(config["trajectory_archive"]["FLUSH_INTERVAL"])
+# Span tracing, see trace_spans.py
+TRACE_DUMP_DIR = config["tracing"]["DUMP_DIR"]
+tracer = Tracer(
+    enabled=config["tracing"]["ENABLE_TRACING"] == "True",
+    ring_size=int(config["tracing"]["RING_SIZE"]),
+    process_name="traffic_injector",
+)
+if tracer.enabled:
+    install_dump_signal(tracer, TRACE_DUMP_DIR)
+# Ownship sample published by user_flight_feeder.py, see ownship_channel.py
+ENABLE_OWNSHIP_CHANNEL = config["ownship_channel"]["ENABLE_OWNSHIP_CHANNEL"] == "True"
+OWNSHIP_SHM_NAME = config["ownship_channel"]["SHM_NAME"]
+# Geoid grid to place aircraft by the WGS-84 height from Narsim, see geoid.py. Without it alt is used.
+GEOID_GRID_FILE = config["geoid"]["GRID_FILE"]
+geoid_model = GeoidModel(GEOID_GRID_FILE) if GEOID_GRID_FILE else None
+# Republishing of the traffic picture to local tools, see traffic_fanout.py
+ENABLE_FANOUT = config["traffic_fanout"]["ENABLE_FANOUT"] == "True"
+FANOUT_TRANSPORT = config["traffic_fanout"]["TRANSPORT"]
+FANOUT_MULTICAST_GROUP = config["traffic_fanout"]["MULTICAST_GROUP"]
+FANOUT_MULTICAST_PORT = int(config["traffic_fanout"]["MULTICAST_PORT"])
+FANOUT_MULTICAST_TTL = int(config["traffic_fanout"]["MULTICAST_TTL"])
+FANOUT_UNIX_SOCKET_PATH = config["traffic_fanout"]["UNIX_SOCKET_PATH"]
+FANOUT_SNAPSHOT_INTERVAL = float(config["traffic_fanout"]["SNAPSHOT_INTERVAL"])
+# Level-of-detail update scheduling, see UpdateScheduler and select_update_tier
+ENABLE_LOD_SCHEDULER = config["traffic_injector"]["ENABLE_LOD_SCHEDULER"] == "True"
+LOD_TIER_RATES = [float(rate) for rate in config["traffic_injector"]["LOD_TIER_RATES"].split(",")]
+# scheduled updates are dispatched once per main loop iteration, so no tier can be faster than the loop
+LOD_MAX_TIER_RATE = 1 / (SOCKET_TIMEOUT + MAIN_LOOP_SLEEP)
+if ENABLE_LOD_SCHEDULER and max(LOD_TIER_RATES) > LOD_MAX_TIER_RATE:
+    print(f'LOD_TIER_RATES above {LOD_MAX_TIER_RATE:.2f} Hz cannot be met by the main loop and are clamped')
+LOD_TIER_RATES = [min(rate, LOD_MAX_TIER_RATE) for rate in LOD_TIER_RATES]
+LOD_TIER_DISTANCES_NM = [float(dist) for dist in config["traffic_injector"]["LOD_TIER_DISTANCES_NM"].split(",")]
+LOD_NO_REFERENCE_TIER = int(config["traffic_injector"]["LOD_NO_REFERENCE_TIER"])
+LOD_OWNSHIP_MAX_AGE = float(config["traffic_injector"]["LOD_OWNSHIP_MAX_AGE"])
+LOD_MANOEUVRE_TURN_RATE = float(config["traffic_injector"]["LOD_MANOEUVRE_TURN_RATE"])
+LOD_MANOEUVRE_V_RATE = float(config["traffic_injector"]["LOD_MANOEUVRE_V_RATE"])
+LOD_GROUND_SPEED_KTS = float(config["traffic_injector"]["LOD_GROUND_SPEED_KTS"])
+LOD_CALL_BUDGET = float(config["traffic_injector"]["LOD_CALL_BUDGET"])
+# the token bucket holds at most one second of budget, below one call nothing would ever be dispatched
+if ENABLE_LOD_SCHEDULER and LOD_CALL_BUDGET < 1:
+    print(f'LOD_CALL_BUDGET {LOD_CALL_BUDGET:g} is below 1 call per second and is clamped to 1')
+LOD_CALL_BUDGET = max(LOD_CALL_BUDGET, 1.0)
+# Flights without truth data for this long [s] are removed (<= 0: never)
+FLIGHT_TIMEOUT = float(config["traffic_injector"]["FLIGHT_TIMEOUT"])
+# Pool of pre-spawned MSFS aircraft objects, see AircraftPool
+ENABLE_AIRCRAFT_POOL = config["traffic_injector"]["ENABLE_AIRCRAFT_POOL"] == "True"
+POOL_SIZE = int(config["traffic_injector"]["POOL_SIZE"])
+POOL_WARMUP = int(config["traffic_injector"]["POOL_WARMUP"])
+POOL_PARK_LAT = float(config["traffic_injector"]["POOL_PARK_LAT"])
+POOL_PARK_LON = float(config["traffic_injector"]["POOL_PARK_LON"])
+POOL_PARK_ALT_FT = float(config["traffic_injector"]["POOL_PARK_ALT_FT"])
+POOL_PARK_SPACING = 0.01  # [deg] of longitude between parked objects
+
+def msfs_altitude_ft(truth: dict) -> float:
+    """Altitude above MSL [ft] to place an aircraft at in MSFS.
+
+    With a geoid grid it is derived from the WGS-84 ellipsoidal height sent by Narsim, otherwise
+    (or outside the grid) Narsim's alt is used.
+
+    Args:
+        truth (dict): decoded truth record of one flight, see function "transform_flight_dict"
+
+    Returns:
+        float: altitude [ft]
+    """
+    if geoid_model is None:
+        return truth['alt']
+    undulation = geoid_model.undulation(truth['lat'] * RAD_TO_DEG, truth['lon'] * RAD_TO_DEG)
+    if undulation is None:
+        return truth['alt']
+    return truth['height'] - undulation * METER_TO_FEET
 
 def create_msfs_aircraft(
     sim_con: SimConnect,
@@ -50,14 +139,14 @@ def create_msfs_aircraft(
 
     callsign = list(flight_truth_dict.keys())[0]
     spawn_pos = init_position(
-        c_double(flight_truth_dict[callsign]["lat"]["lat"]),
-        c_double(flight_truth_dict[callsign]["lat"]["lon"]),
-        c_double(flight_truth_dict[callsign]["lat"]["alt"]),
-        c_double(flight_truth_dict[callsign]["lat"]["pitch"]),
-        c_double(flight_truth_dict[callsign]["lat"]["bank"]),
-        c_double(flight_truth_dict[callsign]["lat"]["crs"]), # TODO: should be heading, but crs entered instead
+        c_double(flight_truth_dict[callsign]["lat"]),
+        c_double(flight_truth_dict[callsign]["lon"]),
+        c_double(msfs_altitude_ft(flight_truth_dict[callsign])),
+        c_double(flight_truth_dict[callsign]["pitch"]),
+        c_double(flight_truth_dict[callsign]["bank"]),
+        c_double(flight_truth_dict[callsign]["crs"]), # TODO: should be heading, but crs entered instead
         DWORD(0), # onGround == 0 (inair) or == 1 (onGround)
-        DWORD(flight_truth_dict[callsign]['gspd']), # TODO: Should be TAS, but gspd entered instead
+        DWORD(int(flight_truth_dict[callsign]['gspd'])), # TODO: Should be TAS, but gspd entered instead
     )
     sim_con.dll.AICreateNonATCAircraft(
         sim_con.hSimConnect, c_char_p(model_title), c_char_p(b"ABCD"), spawn_pos, req_id
@@ -77,20 +166,20 @@ def update_pos_msfs_aircraft(
     updated_pos = init_position(
         c_double(float(flight_truth_dict[callsign]["lat"])),
         c_double(float(flight_truth_dict[callsign]["lon"])),
-        c_double(float(flight_truth_dict[callsign]["alt"]) * METER_TO_FEET),
+        c_double(msfs_altitude_ft(flight_truth_dict[callsign])),  # alt/height are already in ft
         c_double(float(flight_truth_dict[callsign]["pitch"])),  # <- pitch: added after fix from mbjork
         c_double(float(flight_truth_dict[callsign]["bank"])),  # <- bank: added after fix from mbjork
         c_double(int(flight_truth_dict[callsign]["alt"])),
         DWORD(
             0
-            if float(narsim_flight_dict[callsign]["gspd"])
+            if float(flight_truth_dict[callsign]["gspd"])
             * METER_PER_SECOND_TO_KNOTS
             > 100
             else 1
         ),  # TODO: make more sophisticated
         DWORD(
-            float(flight_truth_dict[callsign]["gspd"])
-            * METER_PER_SECOND_TO_KNOTS  # <- airspeed
+            int(float(flight_truth_dict[callsign]["gspd"])
+            * METER_PER_SECOND_TO_KNOTS)  # <- airspeed
         ),
     )
 
@@ -124,8 +213,290 @@ def delete_msfs_aircraft(sim_con: SimConnect, object_id: int) -> int:
 
     return req_id
 
+def percentiles(samples, quantiles=(50, 90, 99)) -> list[float]:
+    """Nearest-rank percentiles of a sequence of samples.
+
+    Args:
+        samples (iterable): numeric samples, does not have to be sorted
+        quantiles (tuple, optional): requested percentiles in [0, 100]. Defaults to (50, 90, 99).
+
+    Returns:
+        list[float]: one value per requested percentile, or None for each if there are no samples
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return [None for _ in quantiles]
+    last_index = len(ordered) - 1
+    return [ordered[min(last_index, max(0, int(round(q / 100 * last_index))))] for q in quantiles]
+
+class DataAgeTracker:
+    """Keeps a rolling window of data age samples per flight and for all flights together.
+
+    Three ages are tracked for every applied update:
+        'net'   : toa -> receive (time from Narsim stamping the message until it was read from the socket)
+        'proc'  : receive -> dispatched (time spent framing, decoding and in SimConnect calls)
+        'total' : toa -> dispatched
+    toa is set by the Narsim host, so 'net' and 'total' include any clock offset between the two machines.
+    """
+    STAGES = ('net', 'proc', 'total')
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.window = window
+        self.per_flight = collections.defaultdict(self._new_stage_dict)
+        self.aggregate = {stage: collections.deque(maxlen=window * 10) for stage in self.STAGES}
+
+    def _new_stage_dict(self) -> dict:
+        return {stage: collections.deque(maxlen=self.window) for stage in self.STAGES}
+
+    def record(self, callsign: str, toa: float, recv_time: float, dispatched_time: float) -> None:
+        ages = {
+            'net': recv_time - toa,
+            'proc': dispatched_time - recv_time,
+            'total': dispatched_time - toa,
+        }
+        for stage, age in ages.items():
+            self.per_flight[callsign][stage].append(age)
+            self.aggregate[stage].append(age)
+
+    def forget(self, callsign: str) -> None:
+        self.per_flight.pop(callsign, None)
+
+    def flight_summary(self, callsign: str) -> dict:
+        """Returns {stage: [p50, p90, p99]} for one flight"""
+        return {stage: percentiles(samples) for stage, samples in self.per_flight[callsign].items()}
+
+    def aggregate_summary(self) -> dict:
+        """Returns {stage: [p50, p90, p99]} over all flights"""
+        return {stage: percentiles(samples) for stage, samples in self.aggregate.items()}
+
+    @staticmethod
+    def format_summary(summary: dict) -> str:
+        parts = []
+        for stage, values in summary.items():
+            if values[0] is None:
+                parts.append(f'{stage} -')
+            else:
+                parts.append(f'{stage} ' + '/'.join(f'{v:.3f}' for v in values))
+        return ', '.join(parts)
+
+def distance_nm(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great circle distance in nautical miles between two positions given in degrees"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_NM * math.asin(min(1.0, math.sqrt(a)))
+
+def select_update_tier(truth: dict, ownship: OwnshipSample = None) -> int:
+    """Choose the update rate tier (index into LOD_TIER_RATES, 0 is the highest rate) of one flight.
+
+    The tier is given by the distance to the ownship (LOD_TIER_DISTANCES_NM), or LOD_NO_REFERENCE_TIER
+    when no ownship is available or its sample is older than LOD_OWNSHIP_MAX_AGE. Manoeuvring flights (turn rate or vertical rate above threshold) are
+    always in tier 0, flights on the ground are moved one tier down.
+
+    Args:
+        truth (dict): decoded truth record of the flight, see function "transform_flight_dict"
+        ownship (OwnshipSample, optional): latest ownship sample. Defaults to None.
+
+    Returns:
+        int: tier index
+    """
+    lowest_tier = len(LOD_TIER_RATES) - 1
+    if abs(truth['turn_rate']) > LOD_MANOEUVRE_TURN_RATE or abs(truth['v_rate']) > LOD_MANOEUVRE_V_RATE:
+        return 0
+    if ownship is None or time.time() - ownship.toa > LOD_OWNSHIP_MAX_AGE:
+        # e.g. the feeder has stopped and its last position is left in the ownship channel
+        tier = LOD_NO_REFERENCE_TIER
+    else:
+        # Narsim positions are in radians, the ownship channel uses degrees
+        dist = distance_nm(truth['lat'] * RAD_TO_DEG, truth['lon'] * RAD_TO_DEG, ownship.lat, ownship.lon)
+        tier = len(LOD_TIER_DISTANCES_NM)
+        for i, tier_distance in enumerate(LOD_TIER_DISTANCES_NM):
+            if dist <= tier_distance:
+                tier = i
+                break
+    if truth['gspd'] < LOD_GROUND_SPEED_KTS:
+        tier += 1
+    return min(tier, lowest_tier)
+
+class UpdateScheduler:
+    """Per-flight update deadlines kept in time buckets, with a fixed budget of SimConnect calls per second.
+
+    Each flight has a deadline of 1/rate of its tier after its last dispatch, stored in the bucket
+    int(deadline / bucket_width). due() collects all flights in buckets up to now and hands out at most
+    as many as the call budget allows, the most overdue relative to their update period first. Flights
+    that did not fit are moved to the current bucket and keep their deadline, so under overload every
+    flight's update period is stretched by the same factor and the tiers keep their relative rates.
+    """
+
+    def __init__(self, tier_rates: list = LOD_TIER_RATES, call_budget: float = LOD_CALL_BUDGET):
+        self.tier_rates = tier_rates
+        self.call_budget = call_budget
+        self.bucket_width = 1 / max(tier_rates)
+        self.buckets = collections.defaultdict(list)
+        # callsign -> bucket of its current deadline, entries in other buckets are stale and skipped
+        self.deadline_bucket = {}
+        self.deadline = {}
+        self.tier = {}
+        # token bucket for the call budget, holds at most one second worth of calls
+        self.tokens = call_budget
+        self.last_refill_time = time.time()
+        self.dispatched = 0
+        self.deferred = 0
+
+    def schedule(self, callsign: str, tier: int, last_dispatch_time: float) -> None:
+        """(Re)schedule a flight for its next update, 1/rate of 'tier' after 'last_dispatch_time'"""
+        deadline = last_dispatch_time + 1 / self.tier_rates[tier]
+        bucket = int(deadline / self.bucket_width)
+        self.tier[callsign] = tier
+        self.deadline[callsign] = deadline
+        self.deadline_bucket[callsign] = bucket
+        self.buckets[bucket].append(callsign)
+
+    def remove(self, callsign: str) -> None:
+        self.deadline_bucket.pop(callsign, None)
+        self.deadline.pop(callsign, None)
+        self.tier.pop(callsign, None)
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.call_budget, self.tokens + (now - self.last_refill_time) * self.call_budget)
+        self.last_refill_time = now
+
+    def due(self, now: float, has_update) -> list[str]:
+        """Flights to update now.
+
+        Args:
+            now (float): current time
+            has_update (callable): has_update(callsign) is True if there is new truth data to send.
+                        Due flights without new data are rescheduled without using the call budget.
+
+        Returns:
+            list[str]: callsigns to dispatch, the caller must schedule() each one again after dispatching
+        """
+        current_bucket = int(now / self.bucket_width)
+        candidates = []
+        for bucket in sorted(b for b in self.buckets if b <= current_bucket):
+            for callsign in self.buckets.pop(bucket):
+                if self.deadline_bucket.get(callsign) != bucket:
+                    continue
+                if has_update(callsign):
+                    candidates.append(callsign)
+                else:
+                    self.schedule(callsign, self.tier[callsign], now)
+
+        self._refill(now)
+        # lateness in units of the flight's own update period
+        candidates.sort(
+            key=lambda callsign: (self.deadline[callsign] - now) * self.tier_rates[self.tier[callsign]]
+        )
+        n_calls = min(len(candidates), int(self.tokens))
+        self.tokens -= n_calls
+        for callsign in candidates[n_calls:]:
+            self.deadline_bucket[callsign] = current_bucket
+            self.buckets[current_bucket].append(callsign)
+        self.dispatched += n_calls
+        self.deferred += len(candidates) - n_calls
+        return candidates[:n_calls]
+
+    def tier_counts(self) -> list[int]:
+        counts = [0 for _ in self.tier_rates]
+        for tier in self.tier.values():
+            counts[tier] += 1
+        return counts
+
+class AircraftPool:
+    """Idle MSFS aircraft objects per model, parked out of view at POOL_PARK_LAT/LON.
+
+    A new flight takes an idle object of its model and has it moved to its position with
+    SetDataOnSimObject, which avoids AICreateNonATCAircraft and its wait for the object ID. The object
+    of a departed flight is parked again and returned to the pool, or deleted if the pool of its model
+    already holds 'size' objects.
+    """
+
+    def __init__(self, sim_con: SimConnect, size: int = POOL_SIZE):
+        self.sim_con = sim_con
+        self.size = size
+        # model title -> object IDs of parked objects
+        self.idle = collections.defaultdict(collections.deque)
+        self.parked_count = 0
+        self.hits = 0
+        self.misses = 0
+        self.returned = 0
+        self.deleted = 0
+        self.warmed_up = 0
+
+    def _park_dict(self) -> dict:
+        """Truth record, in the units of function "transform_flight_dict", of the next parking slot"""
+        # spread the parked objects so they are not all spawned on top of each other
+        slot = self.parked_count % max(self.size, 1)
+        self.parked_count += 1
+        return {f'POOL{slot}': {
+            'lat': POOL_PARK_LAT / RAD_TO_DEG,
+            'lon': (POOL_PARK_LON + slot * POOL_PARK_SPACING) / RAD_TO_DEG,
+            'height': POOL_PARK_ALT_FT,
+            'alt': POOL_PARK_ALT_FT,
+            'gspd': 0.0,
+            'crs': 0.0,
+            'pitch': 0.0,
+            'bank': 0.0,
+        }}
+
+    def warm_up(self, model_title: str, count: int = POOL_WARMUP) -> None:
+        """Spawn parked objects of one model until its pool holds 'count' (at most 'size') objects"""
+        while len(self.idle[model_title]) < min(count, self.size):
+            with tracer.span('pool_spawn') as span:
+                req_id, object_id = create_msfs_aircraft(self.sim_con, self._park_dict(), model_title=model_title)
+                span.set(req_id=req_id, object_id=object_id)
+            self.idle[model_title].append(object_id)
+            self.warmed_up += 1
+
+    def acquire(self, model_title: str, flight_dict: dict) -> int:
+        """Object ID of an aircraft of the model placed at the flight's position, a pooled one if available
+
+        Args:
+            model_title (str): MSFS model title
+            flight_dict (dict): truth record of one flight, see function "transform_flight_dict"
+
+        Returns:
+            int: object ID
+        """
+        if self.idle[model_title]:
+            object_id = self.idle[model_title].popleft()
+            update_pos_msfs_aircraft(self.sim_con, flight_dict, object_id)
+            self.hits += 1
+            return object_id
+        self.misses += 1
+        _, object_id = create_msfs_aircraft(self.sim_con, flight_dict, model_title=model_title)
+        return object_id
+
+    def release(self, model_title: str, object_id: int) -> None:
+        """Park the object of a departed flight and keep it for reuse, or delete it if the pool is full"""
+        if len(self.idle[model_title]) >= self.size:
+            delete_msfs_aircraft(self.sim_con, object_id)
+            self.deleted += 1
+            return
+        update_pos_msfs_aircraft(self.sim_con, self._park_dict(), object_id)
+        self.idle[model_title].append(object_id)
+        self.returned += 1
+
+    def n_idle(self) -> int:
+        return sum(len(object_ids) for object_ids in self.idle.values())
+
+    def delete_all(self) -> None:
+        """Delete all parked objects in MSFS"""
+        for object_ids in self.idle.values():
+            while object_ids:
+                delete_msfs_aircraft(self.sim_con, object_ids.popleft())
+                time.sleep(0.07)
+
 class NarsimFlightsProcessor:
-    def __init__(self, sim_con:SimConnect = None):
+    def __init__(
+        self,
+        sim_con:SimConnect = None,
+        archive:TrajectoryArchiveWriter = None,
+        ownship:OwnshipReader = None,
+        fanout:TrafficFanout = None,
+    ):
         self.callsigns = set()
         # contains unique_callsigns
         self.meta = collections.defaultdict(dict)
@@ -133,9 +504,30 @@ class NarsimFlightsProcessor:
         self.truth_data = collections.defaultdict(dict)
         # updated truth-data with callsign as key
         # TODO: save all object IDs to file and remove them when restarting. Otherwise maybe simobjects stay?
+        self.pool = None
         if sim_con != None and SEND_DATA_TO_MSFS:
             self.sim_con = sim_con
+            if ENABLE_AIRCRAFT_POOL:
+                self.pool = AircraftPool(sim_con)
         self.DEFAULT_AC_MODEL = b"Airbus A320 Neo Asobo"
+        self.data_age = DataAgeTracker()
+        # updates rejected because they were older than, or duplicates of, the current truth state
+        self.dropped_updates = 0
+        self.archive = archive
+        self.ownship = ownship
+        # with the LOD scheduler, updates are sent to MSFS by dispatch_scheduled_updates instead of on arrival
+        self.scheduler = UpdateScheduler() if ENABLE_LOD_SCHEDULER else None
+        # callsign -> receive time of truth data not yet sent to MSFS
+        self.pending_updates = {}
+        self.fanout = fanout
+        # callsign -> latest truth record in fan-out units
+        self.fanout_records = {}
+
+    def get_ownship(self) -> OwnshipSample:
+        """Latest user aircraft sample from the feeder, or None if not available"""
+        if self.ownship is None:
+            return None
+        return self.ownship.read()
 
     def contains_callsign(self, callsign: str) -> bool:
         return callsign in self.flight_callsigns
@@ -154,37 +546,172 @@ class NarsimFlightsProcessor:
         else:
             return self.meta[callsign]['object_id']
 
-    def create_and_add_flight(self, callsign: str, flight_dict) -> None:
+    def create_and_add_flight(self, callsign: str, flight_dict, recv_time: float = None) -> None:
         self.callsigns.add(callsign)
         if SEND_DATA_TO_MSFS:
-            _, object_id = create_msfs_aircraft(self.sim_con, flight_dict, model_title=self.DEFAULT_AC_MODEL)
+            with tracer.span('create', callsign=callsign) as span:
+                if self.pool is not None:
+                    hits = self.pool.hits
+                    object_id = self.pool.acquire(self.DEFAULT_AC_MODEL, flight_dict)
+                    span.set(object_id=object_id, pool_hit=self.pool.hits > hits)
+                else:
+                    req_id, object_id = create_msfs_aircraft(self.sim_con, flight_dict, model_title=self.DEFAULT_AC_MODEL)
+                    span.set(req_id=req_id, object_id=object_id)
             self.meta[callsign]['ac_type'] = 'A20N' # TODO: implemenent aircraft types from flight plan
             self.meta[callsign]['object_id'] = object_id # Object ID from MSFS to use ofr updating/deleting etc
             self.meta[callsign]['ac_model'] = self.DEFAULT_AC_MODEL # TODO: Implement model matching
-            self.meta[callsign]['last_updated_truth_time'] = time.time() # top check how often data is updated
+        self.meta[callsign]['last_updated_truth_time'] = time.time() # top check how often data is updated
         self.truth_data.update(flight_dict)
+        self._record_data_age(callsign, recv_time)
+        # created in MSFS above, so archived right away also with the LOD scheduler
+        self._publish_flight(callsign, recv_time)
+        if self.scheduler is not None:
+            self.scheduler.schedule(callsign, select_update_tier(self.truth_data[callsign], self.get_ownship()), time.time())
+
+    def is_stale_or_duplicate(self, callsign: str, flight_dict) -> bool:
+        """Check an incoming update against the current truth state of the flight.
+
+        Args:
+            callsign (str): callsign of aircraft
+            flight_dict (dict): decoded truth record, see function "transform_flight_dict"
 
-    def update_flights(self, flight_dict_list) -> None:
-        # TODO: set time at last update - such that it can be used to remove flights no longer updated
+        Returns:
+            bool: True if the update is older than the current state, or identical to it
+        """
+        if callsign not in self.truth_data:
+            return False
+        current = self.truth_data[callsign]
+        incoming = flight_dict[callsign]
+        if incoming['toa'] < current['toa']:
+            return True
+        # Narsim stamps toa in whole seconds, so only identical records with the same toa are duplicates
+        return incoming['toa'] == current['toa'] and incoming == current
+
+    def update_flights(self, flight_dict_list, recv_time: float = None) -> None:
+        if recv_time is None:
+            recv_time = time.time()
         for flight_dict in flight_dict_list:
             callsign = list(flight_dict.keys())[0]
-            if callsign in self.callsigns:
-                self.truth_data.update(flight_dict)
-                if SEND_DATA_TO_MSFS:
-                    update_pos_msfs_aircraft(self.sim_con, flight_dict, self.meta[callsign]['object_id'])
-                self.meta[callsign]['last_updated_truth_time'] = time.time()
-            else:
-                # add flight and create in MSFS
-                self.create_and_add_flight(callsign, flight_dict)
+            with tracer.span('state_update', callsign=callsign) as span:
+                if self.is_stale_or_duplicate(callsign, flight_dict):
+                    self.dropped_updates += 1
+                    span.set(dropped=True)
+                    continue
+                if callsign in self.callsigns:
+                    self.truth_data.update(flight_dict)
+                    if self.scheduler is not None:
+                        # sent when the flight is due, see dispatch_scheduled_updates
+                        self.pending_updates[callsign] = recv_time
+                        self.meta[callsign]['last_updated_truth_time'] = time.time()
+                        # archived by dispatch_scheduled_updates if it is sent before a newer update replaces it
+                        self._publish_flight(callsign, recv_time, archive=False)
+                        continue
+                    if SEND_DATA_TO_MSFS:
+                        object_id = self.meta[callsign]['object_id']
+                        with tracer.span('update', callsign=callsign, object_id=object_id):
+                            update_pos_msfs_aircraft(self.sim_con, flight_dict, object_id)
+                    self.meta[callsign]['last_updated_truth_time'] = time.time()
+                    self._record_data_age(callsign, recv_time)
+                    self._publish_flight(callsign, recv_time)
+                else:
+                    # add flight and create in MSFS
+                    self.create_and_add_flight(callsign, flight_dict, recv_time)
+
+    def dispatch_scheduled_updates(self, now: float = None) -> None:
+        """Send the latest truth data of all flights that are due according to the LOD scheduler"""
+        if self.scheduler is None:
+            return
+        if now is None:
+            now = time.time()
+        ownship = self.get_ownship()
+        for callsign in self.scheduler.due(now, self.pending_updates.__contains__):
+            recv_time = self.pending_updates.pop(callsign)
+            if SEND_DATA_TO_MSFS:
+                object_id = self.meta[callsign]['object_id']
+                with tracer.span('update', callsign=callsign, object_id=object_id):
+                    update_pos_msfs_aircraft(self.sim_con, {callsign: self.truth_data[callsign]}, object_id)
+            self._record_data_age(callsign, recv_time)
+            self._archive_flight(callsign, recv_time)
+            self.scheduler.schedule(callsign, select_update_tier(self.truth_data[callsign], ownship), time.time())
+
+    def _record_data_age(self, callsign: str, recv_time: float) -> None:
+        if recv_time is None:
+            return
+        self.data_age.record(callsign, self.truth_data[callsign]['toa'], recv_time, time.time())
+
+    def _record_units(self, callsign: str) -> dict:
+        """Truth data of a flight in the units of the trajectory archive and the traffic fan-out"""
+        record = dict(self.truth_data[callsign])
+        # the archive and the fan-out use lat/lon in degrees, Narsim sends radians
+        record['lat'] *= RAD_TO_DEG
+        record['lon'] *= RAD_TO_DEG
+        return record
+
+    def _archive_flight(self, callsign: str, recv_time: float) -> None:
+        """Write the truth data of a flight, as sent to MSFS, to the trajectory archive"""
+        if self.archive is not None:
+            self.archive.append(callsign, self._record_units(callsign), recv_time)
+
+    def _publish_flight(self, callsign: str, recv_time: float, archive: bool = True) -> None:
+        """Pass new truth data of a flight on to the traffic fan-out and, if it has been sent to MSFS
+        (archive=True), to the trajectory archive"""
+        if (self.archive is None or not archive) and self.fanout is None:
+            return
+        record = self._record_units(callsign)
+        if self.archive is not None and archive:
+            self.archive.append(callsign, record, recv_time)
+        if self.fanout is not None:
+            self.fanout_records[callsign] = record
+            self.fanout.mark_changed(callsign)
+
+    def publish_fanout(self) -> None:
+        """Send the changes of the traffic picture since the last call to fan-out subscribers"""
+        if self.fanout is not None:
+            self.fanout.publish(self.fanout_records)
 
     def remove_flight(self, callsign: str) -> None:
-        NotImplemented
+        """Remove a departed flight, its MSFS object is returned to the aircraft pool or deleted"""
+        if callsign not in self.callsigns:
+            return
+        if SEND_DATA_TO_MSFS:
+            object_id = self.meta[callsign]['object_id']
+            if self.pool is not None:
+                with tracer.span('release', callsign=callsign, object_id=object_id):
+                    self.pool.release(self.meta[callsign]['ac_model'], object_id)
+            else:
+                with tracer.span('delete', callsign=callsign) as span:
+                    span.set(req_id=delete_msfs_aircraft(self.sim_con, object_id))
+        self.callsigns.discard(callsign)
+        self.meta.pop(callsign, None)
+        self.truth_data.pop(callsign, None)
+        self.pending_updates.pop(callsign, None)
+        self.data_age.forget(callsign)
+        if self.scheduler is not None:
+            self.scheduler.remove(callsign)
+        if self.fanout is not None:
+            self.fanout_records.pop(callsign, None)
+            self.fanout.mark_removed(callsign)
+
+    def remove_stale_flights(self, now: float = None) -> None:
+        """Remove the flights without new truth data for FLIGHT_TIMEOUT seconds"""
+        if FLIGHT_TIMEOUT <= 0:
+            return
+        if now is None:
+            now = time.time()
+        stale = [cs for cs in self.callsigns if now - self.meta[cs]['last_updated_truth_time'] > FLIGHT_TIMEOUT]
+        for cs in stale:
+            self.remove_flight(cs)
 
     def remove_all(self) -> None:
         for cs in self.callsigns:
             if SEND_DATA_TO_MSFS:
-                delete_msfs_aircraft(self.sim_con, self.meta[cs]['object_id'])
+                with tracer.span('delete', callsign=cs) as span:
+                    span.set(req_id=delete_msfs_aircraft(self.sim_con, self.meta[cs]['object_id']))
                 time.sleep(0.07)
+        if self.pool is not None:
+            self.pool.delete_all()
+        if self.fanout is not None:
+            self.fanout.close()
         print('all injected aircraft deleted in MSFS, success!')
         print('Closing...')
 
@@ -196,10 +723,30 @@ class NarsimFlightsProcessor:
 
     def print_status_on_flights(self) -> None:
         print('---- INJECTOR STATUS ----')
-        print('callsign, time of last data update')
+        print('callsign, time of last data update, data age p50/p90/p99 [s]')
         for cs in self.callsigns:
             localtime = time.strftime('%H:%M:%S', time.localtime(self.meta[cs]['last_updated_truth_time']))
-            print(cs, localtime)
+            print(cs, localtime, DataAgeTracker.format_summary(self.data_age.flight_summary(cs)))
+        print('all flights, data age p50/p90/p99 [s]:', DataAgeTracker.format_summary(self.data_age.aggregate_summary()))
+        print('dropped stale/duplicate updates:', self.dropped_updates)
+        if self.scheduler is not None:
+            tier_counts = ', '.join(
+                f'{rate:g} Hz: {count}' for rate, count in zip(self.scheduler.tier_rates, self.scheduler.tier_counts())
+            )
+            print(f'LOD tiers [{tier_counts}], updates sent: {self.scheduler.dispatched}, '
+                  f'deferred by call budget: {self.scheduler.deferred}')
+        if self.pool is not None:
+            print(f'aircraft pool: {self.pool.n_idle()} parked, hits: {self.pool.hits}, misses: {self.pool.misses}, '
+                  f'returned: {self.pool.returned}, deleted (pool full): {self.pool.deleted}, '
+                  f'spawned at warm-up: {self.pool.warmed_up}')
+        if self.fanout is not None:
+            print(f'traffic fan-out ({self.fanout.transport}): {self.fanout.frames_sent} frames, '
+                  f'{self.fanout.bytes_sent} bytes sent, subscribers: {self.fanout.n_subscribers()}, '
+                  f'dropped subscribers: {self.fanout.subscribers_dropped}')
+        ownship = self.get_ownship()
+        if ownship is not None:
+            print(f'ownship: lat {ownship.lat:.5f} lon {ownship.lon:.5f} alt {ownship.alt:.0f} ft, '
+                  f'age {time.time() - ownship.toa:.2f} s')
         print('-------------------------')
 
 
@@ -208,6 +755,7 @@ def transform_flight_dict(flight_dict:dict) -> dict:
     output = collections.defaultdict(dict)
 
     cs = flight_dict['truth']['callsign']
+    toa = float(flight_dict["truth"]["toa"]) # time of applicability set by Narsim [s]
     ssr_s = int(flight_dict["truth"]["ssr_s"])
     ssr_c = int(flight_dict["truth"]["ssr_c"])
     ssr_a = int(flight_dict["truth"]["ssr_a"])
@@ -224,6 +772,7 @@ def transform_flight_dict(flight_dict:dict) -> dict:
     pitch = float(flight_dict["truth"]["pitch"]["#text"]) # pitch, no unit
     bank = float(flight_dict["truth"]["bank"]["#text"])# bank, no unit
 
+    output[cs]['toa'] = toa
     output[cs]['ssr_s'] = ssr_s
     output[cs]['ssr_c'] = ssr_c
     output[cs]['ssr_a'] = ssr_a
@@ -286,6 +835,10 @@ def parse_narsim_data(narsim_msg:str, outer_partial_msg):
     truth_output = []
     flightplan_output = [] # TODO: implement flightplan parsing
 
+    # nothing received within the socket timeout
+    if not narsim_msg:
+        return outer_partial_msg, truth_output
+
     # check: if contains '<?xml' <=> message is from Narsim
     if "<?xml" not in narsim_msg:
         raise Exception("<?xml not in msg received over tcp, is narsim connected?")
@@ -302,7 +855,9 @@ def parse_narsim_data(narsim_msg:str, outer_partial_msg):
         splt_str[1] = splt_str[1].strip("\n")
         xml_object = splt_str[0].strip()
         if '<truth>' in xml_object:
-            truth_output.append(truth_xml_2_dict(xml_object))
+            with tracer.span('decode') as span:
+                truth_output.append(truth_xml_2_dict(xml_object))
+                span.set(callsign=list(truth_output[-1].keys())[0])
         elif '<flightplan>' in xml_object:
             raise Exception('flightplan parsing not implemented')
         else:
@@ -313,24 +868,48 @@ def parse_narsim_data(narsim_msg:str, outer_partial_msg):
 
     return outer_partial_msg, truth_output
 
-def exit_handler(signum, frame, injector_engine:NarsimFlightsProcessor):
+def exit_handler(signum, frame):
     res = input("Ctrl+c was pressed. Do you really want to exit? y/n")
     if res == 'y':
-        injector_engine.remove_all()
-        time.sleep(0.1)
+        # injected and parked aircraft are deleted by the finally block of injector_process
         exit(1)
 
 signal.signal(signal.SIGINT, exit_handler)
 
 def injector_process(sim_con: SimConnect = None, sock:socket = None):
 
+    archive = None
+    if ENABLE_ARCHIVE:
+        archive = TrajectoryArchiveWriter(
+            new_session_dir(ARCHIVE_DIR, 'traffic_injector'),
+            chunk_rows=ARCHIVE_CHUNK_ROWS,
+            flush_interval=ARCHIVE_FLUSH_INTERVAL,
+        )
+
+    ownship = None
+    if ENABLE_OWNSHIP_CHANNEL:
+        ownship = OwnshipReader(OWNSHIP_SHM_NAME)
+
+    fanout = None
+    if ENABLE_FANOUT:
+        fanout = TrafficFanout(
+            FANOUT_TRANSPORT,
+            multicast_group=FANOUT_MULTICAST_GROUP,
+            multicast_port=FANOUT_MULTICAST_PORT,
+            multicast_ttl=FANOUT_MULTICAST_TTL,
+            unix_socket_path=FANOUT_UNIX_SOCKET_PATH,
+            snapshot_interval=FANOUT_SNAPSHOT_INTERVAL,
+        )
+
     if SEND_DATA_TO_MSFS:
-        injector_engine = NarsimFlightsProcessor(sim_con=sim_con)
+        injector_engine = NarsimFlightsProcessor(sim_con=sim_con, archive=archive, ownship=ownship, fanout=fanout)
+        if injector_engine.pool is not None:
+            injector_engine.pool.warm_up(injector_engine.DEFAULT_AC_MODEL)
+            print(f'aircraft pool: {injector_engine.pool.warmed_up} aircraft spawned and parked')
     else:
-        injector_engine = NarsimFlightsProcessor()
+        injector_engine = NarsimFlightsProcessor(archive=archive, ownship=ownship, fanout=fanout)
 
-    socket_timeout_duration = 0.2
-    sock.settimeout(socket_timeout_duration)
+    sock.settimeout(SOCKET_TIMEOUT)
 
     # Initialize time.
     last_time = time.time()
@@ -339,21 +918,39 @@ def injector_process(sim_con: SimConnect = None, sock:socket = None):
     outer_partial_msg = ''
 
     # Main loop
-    while True:
-        current_time = time.time()
-        if current_time >= last_time + TIME_INTERVAL_INJECTOR:
-            last_time = current_time
-
-        # read data from NARSIM
-        narsim_msg = read_instant_all_narsim_data(sock)
-        outer_partial_msg, flight_list = parse_narsim_data(narsim_msg, outer_partial_msg)
-        injector_engine.update_flights(flight_list)
-
-        if current_time >= last_logging_time + CONSOLE_LOGGING_TIME_INTERVAL:
-            last_logging_time = current_time
-            injector_engine.print_status_on_flights()
-
-        time.sleep(0.10)  # lower load on CPU by not looping unnecessarily much
+    try:
+        while True:
+            current_time = time.time()
+            if current_time >= last_time + TIME_INTERVAL_INJECTOR:
+                last_time = current_time
+
+            # read data from NARSIM
+            with tracer.span('receive') as span:
+                narsim_msg = read_instant_all_narsim_data(sock)
+                span.set(chars=len(narsim_msg))
+            recv_time = time.time()
+            with tracer.span('frame') as span:
+                outer_partial_msg, flight_list = parse_narsim_data(narsim_msg, outer_partial_msg)
+                span.set(flights=len(flight_list))
+            injector_engine.update_flights(flight_list, recv_time=recv_time)
+            injector_engine.dispatch_scheduled_updates()
+            injector_engine.remove_stale_flights()
+            injector_engine.publish_fanout()
+            if archive is not None:
+                archive.flush_if_due()
+
+            if current_time >= last_logging_time + CONSOLE_LOGGING_TIME_INTERVAL:
+                last_logging_time = current_time
+                injector_engine.print_status_on_flights()
+
+            time.sleep(MAIN_LOOP_SLEEP)  # lower load on CPU by not looping unnecessarily much
+    finally:
+        try:
+            injector_engine.remove_all()
+        finally:
+            if archive is not None:
+                archive.close()
+                print(f'trajectory archive written to {archive.session_dir}')
 
 
 
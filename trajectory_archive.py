@@ -0,0 +1,325 @@
+"""
+Columnar on-disk archive of decoded truth records, written by the traffic injector and the
+user flight feeder and read back with memory-mapped files for analysis after an exercise.
+
+A session is a directory containing:
+    callsigns.txt       one callsign per line, the line number is the callsign ID
+    chunk_NNNNNN.col    fixed-width columnar chunk: a 16 byte header followed by one
+                        8 byte wide column per field, each column 'capacity' rows long,
+                        of which the first 'nrows' are filled
+    index.bin           one (chunk_no, nrows, toa_min, toa_max) record per chunk, at offset
+                        chunk_no * INDEX_RECORD.size
+    tracks.bin          one (callsign_id, chunk_no) record per callsign present in a chunk
+
+Units in the archive: lat/lon [deg], alt/height [ft], gspd [kts], crs [deg], v_rate [m/s],
+turn_rate, pitch and bank as received from the source.
+"""
+import array
+import collections
+import mmap
+import os
+import struct
+import sys
+import time
+
+CHUNK_MAGIC = b"TRJC"
+CHUNK_VERSION = 1
+CHUNK_HEADER = struct.Struct("<4sIII")  # magic, version, capacity, nrows
+CHUNK_HEADER_SIZE = 16
+INDEX_RECORD = struct.Struct("<IIdd")  # chunk_no, nrows, toa_min, toa_max
+TRACK_RECORD = struct.Struct("<II")  # callsign_id, chunk_no
+
+# (column name, array typecode), all columns are 8 bytes wide
+COLUMNS = (
+    ("callsign_id", "q"),
+    ("toa", "d"),
+    ("recv_time", "d"),
+    ("lat", "d"),
+    ("lon", "d"),
+    ("alt", "d"),
+    ("height", "d"),
+    ("gspd", "d"),
+    ("crs", "d"),
+    ("v_rate", "d"),
+    ("turn_rate", "d"),
+    ("pitch", "d"),
+    ("bank", "d"),
+)
+COLUMN_NAMES = tuple(name for name, _ in COLUMNS)
+RECORD_FIELDS = COLUMN_NAMES[3:]
+
+TrajectoryRow = collections.namedtuple("TrajectoryRow", ("callsign",) + COLUMN_NAMES[1:])
+
+
+def new_session_dir(archive_dir: str, source: str) -> str:
+    """Directory for a new session of 'source', e.g. ./archive/traffic_injector/20221129-142501"""
+    return os.path.join(archive_dir, source, time.strftime("%Y%m%d-%H%M%S"))
+
+
+class TrajectoryArchiveWriter:
+    """Appends truth records to a session directory, one chunk file per 'chunk_rows' records.
+
+    Records are buffered in memory column by column. A chunk file is created with room for
+    'chunk_rows' records, and every flush writes the buffered records into the free part of each
+    column and then updates the chunk header and its index record in place, so a chunk fills up
+    over several flushes. Buffered records are flushed when 'flush_interval' seconds have passed
+    since the first of them, so at most that much data is lost if the process is killed. The check
+    runs in append() and flush_if_due(), which the owner calls periodically so buffered records are
+    also written when no new records arrive.
+    """
+
+    def __init__(self, session_dir: str, chunk_rows: int = 8192, flush_interval: float = 10.0):
+        os.makedirs(session_dir, exist_ok=True)
+        self.session_dir = session_dir
+        self.chunk_rows = chunk_rows
+        self.flush_interval = flush_interval
+
+        self.callsign_ids = {}
+        self._callsign_file = open(os.path.join(session_dir, "callsigns.txt"), "a", encoding="utf-8")
+        # written at chunk_no * INDEX_RECORD.size, so not opened in append mode
+        self._index_file = open(os.path.join(session_dir, "index.bin"), "wb")
+        self._tracks_file = open(os.path.join(session_dir, "tracks.bin"), "ab")
+        self.chunk_no = 0
+        self._start_chunk()
+        self._reset_buffers()
+
+    def _start_chunk(self) -> None:
+        self._chunk_file = None
+        self._chunk_nrows = 0
+        self._chunk_callsigns = set()
+        self._toa_min = float("inf")
+        self._toa_max = float("-inf")
+
+    def _reset_buffers(self) -> None:
+        self._columns = [array.array(typecode) for _, typecode in COLUMNS]
+        self._new_callsigns = set()
+        self._first_append_time = None
+
+    def _callsign_id(self, callsign: str) -> int:
+        callsign_id = self.callsign_ids.get(callsign)
+        if callsign_id is None:
+            callsign_id = len(self.callsign_ids)
+            self.callsign_ids[callsign] = callsign_id
+            self._callsign_file.write(callsign + "\n")
+            self._callsign_file.flush()
+        return callsign_id
+
+    def append(self, callsign: str, record: dict, recv_time: float = None) -> None:
+        """Append one truth record.
+
+        Args:
+            callsign (str): callsign of aircraft
+            record (dict): dict with key 'toa' and the keys in RECORD_FIELDS, in archive units
+            recv_time (float, optional): time the record was received/sampled. Defaults to 'toa'.
+        """
+        callsign_id = self._callsign_id(callsign)
+        toa = float(record["toa"])
+        columns = self._columns
+        columns[0].append(callsign_id)
+        columns[1].append(toa)
+        columns[2].append(toa if recv_time is None else recv_time)
+        for column, field in zip(columns[3:], RECORD_FIELDS):
+            column.append(float(record.get(field, 0.0)))
+
+        if callsign_id not in self._chunk_callsigns:
+            self._chunk_callsigns.add(callsign_id)
+            self._new_callsigns.add(callsign_id)
+        if toa < self._toa_min:
+            self._toa_min = toa
+        if toa > self._toa_max:
+            self._toa_max = toa
+
+        if self._first_append_time is None:
+            self._first_append_time = time.time()
+        if self._chunk_nrows + len(columns[0]) >= self.chunk_rows:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self, now: float = None) -> None:
+        """Flush the buffered records if the oldest was appended 'flush_interval' seconds ago"""
+        if self._first_append_time is None:
+            return
+        if now is None:
+            now = time.time()
+        if now - self._first_append_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered records into the current chunk file and update the indexes"""
+        nrows = len(self._columns[0])
+        if nrows == 0:
+            return
+        chunk_file = self._chunk_file
+        if chunk_file is None:
+            chunk_path = os.path.join(self.session_dir, f"chunk_{self.chunk_no:06d}.col")
+            chunk_file = self._chunk_file = open(chunk_path, "w+b")
+            chunk_file.truncate(CHUNK_HEADER_SIZE + len(COLUMNS) * self.chunk_rows * 8)
+        for i, column in enumerate(self._columns):
+            chunk_file.seek(CHUNK_HEADER_SIZE + (i * self.chunk_rows + self._chunk_nrows) * 8)
+            column.tofile(chunk_file)
+        self._chunk_nrows += nrows
+        # the header and index are updated after the data, so readers never see unwritten rows
+        chunk_file.seek(0)
+        header = CHUNK_HEADER.pack(CHUNK_MAGIC, CHUNK_VERSION, self.chunk_rows, self._chunk_nrows)
+        chunk_file.write(header.ljust(CHUNK_HEADER_SIZE, b"\0"))
+        chunk_file.flush()
+
+        self._index_file.seek(self.chunk_no * INDEX_RECORD.size)
+        self._index_file.write(INDEX_RECORD.pack(self.chunk_no, self._chunk_nrows, self._toa_min, self._toa_max))
+        self._index_file.flush()
+        if self._new_callsigns:
+            self._tracks_file.write(
+                b"".join(TRACK_RECORD.pack(callsign_id, self.chunk_no) for callsign_id in sorted(self._new_callsigns))
+            )
+            self._tracks_file.flush()
+        self._reset_buffers()
+
+        if self._chunk_nrows >= self.chunk_rows:
+            chunk_file.close()
+            self.chunk_no += 1
+            self._start_chunk()
+
+    def close(self) -> None:
+        self.flush()
+        if self._chunk_file is not None:
+            self._chunk_file.close()
+            self._chunk_file = None
+        self._callsign_file.close()
+        self._index_file.close()
+        self._tracks_file.close()
+
+
+class TrajectoryArchive:
+    """Read-only view of a session directory.
+
+    Only the small index files are read when opening. Chunk files are memory-mapped on first use
+    and their columns are accessed through memoryviews, so a query touches only the chunks whose
+    time range or callsign list matches.
+    """
+
+    def __init__(self, session_dir: str):
+        self.session_dir = session_dir
+        with open(os.path.join(session_dir, "callsigns.txt"), encoding="utf-8") as callsign_file:
+            self.callsign_list = [line.rstrip("\n") for line in callsign_file]
+        self.callsign_ids = {callsign: i for i, callsign in enumerate(self.callsign_list)}
+
+        # chunk_no -> (nrows, toa_min, toa_max)
+        self.index = {}
+        with open(os.path.join(session_dir, "index.bin"), "rb") as index_file:
+            data = index_file.read()
+        for chunk_no, nrows, toa_min, toa_max in INDEX_RECORD.iter_unpack(data[: len(data) - len(data) % INDEX_RECORD.size]):
+            self.index[chunk_no] = (nrows, toa_min, toa_max)
+
+        # callsign_id -> [chunk_no, ...]
+        self.tracks = collections.defaultdict(list)
+        with open(os.path.join(session_dir, "tracks.bin"), "rb") as tracks_file:
+            data = tracks_file.read()
+        for callsign_id, chunk_no in TRACK_RECORD.iter_unpack(data[: len(data) - len(data) % TRACK_RECORD.size]):
+            if chunk_no in self.index:
+                self.tracks[callsign_id].append(chunk_no)
+
+        self._mapped = {}
+
+    def callsigns(self) -> list[str]:
+        return list(self.callsign_list)
+
+    def time_span(self) -> tuple[float, float]:
+        """First and last toa in the session, or (None, None) if it is empty"""
+        if not self.index:
+            return None, None
+        return (
+            min(toa_min for _, toa_min, _ in self.index.values()),
+            max(toa_max for _, _, toa_max in self.index.values()),
+        )
+
+    def _columns(self, chunk_no: int) -> dict:
+        """Memory-map a chunk and return {column name: memoryview}"""
+        if chunk_no in self._mapped:
+            return self._mapped[chunk_no][2]
+        chunk_path = os.path.join(self.session_dir, f"chunk_{chunk_no:06d}.col")
+        with open(chunk_path, "rb") as chunk_file:
+            mapped = mmap.mmap(chunk_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, capacity, nrows = CHUNK_HEADER.unpack_from(mapped, 0)
+        if magic != CHUNK_MAGIC or version != CHUNK_VERSION:
+            raise Exception(f"not a trajectory archive chunk: {chunk_path}")
+        view = memoryview(mapped)
+        columns = {}
+        for i, (name, typecode) in enumerate(COLUMNS):
+            start = CHUNK_HEADER_SIZE + i * capacity * 8
+            columns[name] = view[start : start + nrows * 8].cast(typecode)
+        self._mapped[chunk_no] = (mapped, view, columns)
+        return columns
+
+    def _row(self, columns: dict, i: int) -> TrajectoryRow:
+        return TrajectoryRow(
+            self.callsign_list[columns["callsign_id"][i]],
+            *(columns[name][i] for name in COLUMN_NAMES[1:]),
+        )
+
+    def window(self, t0: float, t1: float) -> list[TrajectoryRow]:
+        """All records of all flights with t0 <= toa <= t1, sorted by toa"""
+        rows = []
+        for chunk_no, (_, toa_min, toa_max) in sorted(self.index.items()):
+            if toa_max < t0 or toa_min > t1:
+                continue
+            columns = self._columns(chunk_no)
+            toa = columns["toa"]
+            if t0 <= toa_min and toa_max <= t1:
+                rows.extend(self._row(columns, i) for i in range(len(toa)))
+            else:
+                rows.extend(self._row(columns, i) for i in range(len(toa)) if t0 <= toa[i] <= t1)
+        rows.sort(key=lambda row: row.toa)
+        return rows
+
+    def track(self, callsign: str, t0: float = float("-inf"), t1: float = float("inf")) -> list[TrajectoryRow]:
+        """All records of one callsign with t0 <= toa <= t1, sorted by toa"""
+        callsign_id = self.callsign_ids.get(callsign)
+        if callsign_id is None:
+            return []
+        rows = []
+        for chunk_no in self.tracks[callsign_id]:
+            _, toa_min, toa_max = self.index[chunk_no]
+            if toa_max < t0 or toa_min > t1:
+                continue
+            columns = self._columns(chunk_no)
+            ids = columns["callsign_id"]
+            toa = columns["toa"]
+            rows.extend(
+                self._row(columns, i) for i in range(len(ids)) if ids[i] == callsign_id and t0 <= toa[i] <= t1
+            )
+        rows.sort(key=lambda row: row.toa)
+        return rows
+
+    def close(self) -> None:
+        for mapped, view, columns in self._mapped.values():
+            for column in columns.values():
+                column.release()
+            view.release()
+            mapped.close()
+        self._mapped.clear()
+
+
+def main(argv: list[str]) -> None:
+    """Print a session summary, or records of a time window / callsign
+
+    usage: python trajectory_archive.py <session_dir> [callsign] [t0 t1]
+    """
+    if not argv:
+        print(main.__doc__)
+        return
+    archive = TrajectoryArchive(argv[0])
+    t0, t1 = archive.time_span()
+    print(f"{len(archive.callsign_list)} callsigns, {len(archive.index)} chunks, toa {t0} - {t1}")
+    if len(argv) in (2, 4):
+        window = (float(argv[-2]), float(argv[-1])) if len(argv) == 4 else (float("-inf"), float("inf"))
+        for row in archive.track(argv[1], *window):
+            print(row)
+    elif len(argv) == 3:
+        for row in archive.window(float(argv[1]), float(argv[2])):
+            print(row)
+    archive.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -3,9 +3,16 @@ This file includes code to retrieve data from msfs and feed it to Narsim.
 """
 import socket
 import time
+import math
+import collections
 import configparser
 from SimConnect import SimConnect, AircraftRequests
 
+from trajectory_archive import TrajectoryArchiveWriter, new_session_dir
+from trace_spans import Tracer, install_dump_signal
+from ownship_channel import OwnshipPublisher
+from geoid import GeoidModel
+
 # from SimConnect.Enum import *
 
 # Constants
@@ -13,6 +20,7 @@ KNOTS_TO_METER_PER_SEC = 0.51444
 FEET_TO_METER = 0.3048
 METER_TO_FEET = 3.2808399
 DEG_TO_RAD = 0.0174532925
+EARTH_RADIUS_M = 6371000.0
 
 # config for e.g. connections
 config = configparser.ConfigParser()
@@ -38,6 +46,40 @@ TIME_INTERVAL_USER_FLIGHT_FEEDER = 1 / float(
 SEND_DATA_TO_NARSIM = config["user_flight_feeder"]["SEND_DATA_TO_NARSIM"]
 SEND_DATA_TO_NARSIM = SEND_DATA_TO_NARSIM == "True"
 
+# Adaptive send rate, see AdaptiveSendController. Replaces UPDATE_FREQUENCY when enabled.
+ADAPTIVE_SEND = config["user_flight_feeder"]["ADAPTIVE_SEND"] == "True"
+ADAPTIVE_POS_THRESHOLD_M = float(config["user_flight_feeder"]["ADAPTIVE_POS_THRESHOLD_M"])
+ADAPTIVE_ALT_THRESHOLD_FT = float(config["user_flight_feeder"]["ADAPTIVE_ALT_THRESHOLD_FT"])
+ADAPTIVE_HDG_THRESHOLD_DEG = float(config["user_flight_feeder"]["ADAPTIVE_HDG_THRESHOLD_DEG"])
+ADAPTIVE_SPD_THRESHOLD_KTS = float(config["user_flight_feeder"]["ADAPTIVE_SPD_THRESHOLD_KTS"])
+ADAPTIVE_MIN_RATE = float(config["user_flight_feeder"]["ADAPTIVE_MIN_RATE"])
+ADAPTIVE_MAX_RATE = float(config["user_flight_feeder"]["ADAPTIVE_MAX_RATE"])
+ADAPTIVE_REPORT_INTERVAL = float(config["user_flight_feeder"]["ADAPTIVE_REPORT_INTERVAL"])
+
+# Archive of sent truth records, see trajectory_archive.py
+ENABLE_ARCHIVE = config["trajectory_archive"]["ENABLE_ARCHIVE"] == "True"
+ARCHIVE_DIR = config["trajectory_archive"]["ARCHIVE_DIR"]
+ARCHIVE_CHUNK_ROWS = int(config["trajectory_archive"]["CHUNK_ROWS"])
+ARCHIVE_FLUSH_INTERVAL = float(config["trajectory_archive"]["FLUSH_INTERVAL"])
+
+# Span tracing, see trace_spans.py
+TRACE_DUMP_DIR = config["tracing"]["DUMP_DIR"]
+tracer = Tracer(
+    enabled=config["tracing"]["ENABLE_TRACING"] == "True",
+    ring_size=int(config["tracing"]["RING_SIZE"]),
+    process_name="user_flight_feeder",
+)
+if tracer.enabled:
+    install_dump_signal(tracer, TRACE_DUMP_DIR)
+
+# Latest ownship sample published to shared memory, see ownship_channel.py
+ENABLE_OWNSHIP_CHANNEL = config["ownship_channel"]["ENABLE_OWNSHIP_CHANNEL"] == "True"
+OWNSHIP_SHM_NAME = config["ownship_channel"]["SHM_NAME"]
+
+# Geoid grid for the WGS-84 height sent to Narsim, see geoid.py. Without it height is MSL.
+GEOID_GRID_FILE = config["geoid"]["GRID_FILE"]
+geoid_model = GeoidModel(GEOID_GRID_FILE) if GEOID_GRID_FILE else None
+
 XML_TEMPLATE_TRUTH = (
     '<?xml version="1.0" encoding="UTF-8"?>'
     '<NLRIn source="NARSIM" xmlns:sti="http://www.w3.org/2001/XMLSchema-instance">'
@@ -69,7 +111,7 @@ Confirmed and working as of 29 nov 2022. Unit as received from SimConnect accord
 LAT_VARNAME = "PLANE_LATITUDE"  # [degrees]
 LON_VARNAME = "PLANE_LONGITUDE"  # [degrees]
 ALT_VARNAME = "PLANE_ALTITUDE"  # [ft]
-HEIGHT_VARNAME = "PLANE_ALTITUDE"  # [ft]
+HEIGHT_VARNAME = "PLANE_ALTITUDE"  # [ft], converted to WGS-84 height with the geoid grid
 GSPD_VARNAME = "GROUND_VELOCITY"  # [kts]
 CRS_VARNAME = "PLANE_HEADING_DEGREES_TRUE"  # [radians]
 V_RATE_VARNAME = "VERTICAL_SPEED"  # [feet per second]
@@ -123,6 +165,177 @@ def connect_narsim(sock: socket.socket) -> bool:
         return None
 
 
+def ownship_record(translation_dict: dict, toa: float) -> dict:
+    """Convert a sent truth record to the units of the trajectory archive and the ownship channel
+
+    Args:
+        translation_dict (dict): values formatted into XML_TEMPLATE_TRUTH
+        toa (float): time the sample was taken
+
+    Returns:
+        dict: record for TrajectoryArchiveWriter.append and OwnshipPublisher.publish
+    """
+    return {
+        "toa": toa,
+        "lat": translation_dict["lat"],
+        "lon": translation_dict["lon"],
+        "alt": translation_dict["alt"],
+        "height": translation_dict["height"] * METER_TO_FEET,
+        "gspd": translation_dict["gspd"] / KNOTS_TO_METER_PER_SEC,
+        "crs": translation_dict["crs"] / DEG_TO_RAD,
+        "v_rate": translation_dict["v_rate"],
+        "turn_rate": translation_dict["turn_rate"],
+        "pitch": translation_dict["pitch"],
+        "bank": translation_dict["bank"],
+    }
+
+
+class AdaptiveSendController:
+    """Decides when a new ownship sample has to be sent to Narsim.
+
+    The last sent sample is extrapolated (dead reckoning with speed, course and vertical rate) to the
+    time of the new sample, as a receiver of the truth data would do. Only fields that are in
+    XML_TEMPLATE_TRUTH are used: turn_rate is not sent, so a receiver extrapolates a turn as a
+    straight line and the prediction must do the same. The sample
+    is sent when the prediction error in position, altitude, heading or speed exceeds its threshold,
+    but never more often than max_rate, and otherwise as a heartbeat at min_rate.
+
+    Samples are dicts in the units of function "ownship_record".
+    """
+
+    ERRORS = ("pos_m", "alt_ft", "hdg_deg", "spd_kts")
+
+    def __init__(
+        self,
+        pos_threshold_m: float = ADAPTIVE_POS_THRESHOLD_M,
+        alt_threshold_ft: float = ADAPTIVE_ALT_THRESHOLD_FT,
+        hdg_threshold_deg: float = ADAPTIVE_HDG_THRESHOLD_DEG,
+        spd_threshold_kts: float = ADAPTIVE_SPD_THRESHOLD_KTS,
+        min_rate: float = ADAPTIVE_MIN_RATE,
+        max_rate: float = ADAPTIVE_MAX_RATE,
+    ):
+        self.thresholds = {
+            "pos_m": pos_threshold_m,
+            "alt_ft": alt_threshold_ft,
+            "hdg_deg": hdg_threshold_deg,
+            "spd_kts": spd_threshold_kts,
+        }
+        self.min_interval = 1 / min_rate
+        self.max_interval = 1 / max_rate
+        self.last_sent = None
+        self.last_sent_time = None
+        # statistics since the last report
+        self.send_reasons = collections.Counter()
+        self.error_sum = dict.fromkeys(self.ERRORS, 0.0)
+        self.error_max = dict.fromkeys(self.ERRORS, 0.0)
+        self.n_samples = 0
+        self.report_start_time = time.time()
+
+    @staticmethod
+    def predict(sample: dict, dt: float) -> dict:
+        """Dead-reckon a sample dt seconds ahead on a straight line, from the fields sent to Narsim"""
+        distance_m = sample["gspd"] * KNOTS_TO_METER_PER_SEC * dt
+        crs = sample["crs"] * DEG_TO_RAD
+        lat = sample["lat"] + distance_m * math.cos(crs) / EARTH_RADIUS_M / DEG_TO_RAD
+        lon = sample["lon"] + distance_m * math.sin(crs) / (
+            EARTH_RADIUS_M * max(math.cos(sample["lat"] * DEG_TO_RAD), 1e-6)
+        ) / DEG_TO_RAD
+        return {
+            "lat": lat,
+            "lon": lon,
+            "alt": sample["alt"] + sample["v_rate"] * dt * METER_TO_FEET,
+            "crs": sample["crs"],
+            "gspd": sample["gspd"],
+        }
+
+    @staticmethod
+    def prediction_errors(predicted: dict, actual: dict) -> dict:
+        d_north = (actual["lat"] - predicted["lat"]) * DEG_TO_RAD * EARTH_RADIUS_M
+        d_east = (
+            (actual["lon"] - predicted["lon"]) * DEG_TO_RAD * EARTH_RADIUS_M * math.cos(actual["lat"] * DEG_TO_RAD)
+        )
+        return {
+            "pos_m": math.hypot(d_north, d_east),
+            "alt_ft": abs(actual["alt"] - predicted["alt"]),
+            "hdg_deg": abs((actual["crs"] - predicted["crs"] + 180) % 360 - 180),
+            "spd_kts": abs(actual["gspd"] - predicted["gspd"]),
+        }
+
+    def should_send(self, sample: dict, now: float) -> bool:
+        """Check a new sample, returns True if it should be sent. The caller must send it if True."""
+        if self.last_sent is None:
+            return self._sent(sample, now, "first")
+        elapsed = now - self.last_sent_time
+        if elapsed < self.max_interval:
+            return False
+
+        errors = self.prediction_errors(self.predict(self.last_sent, elapsed), sample)
+        self.n_samples += 1
+        for name, error in errors.items():
+            self.error_sum[name] += error
+            self.error_max[name] = max(self.error_max[name], error)
+
+        exceeded = [name for name, error in errors.items() if error > self.thresholds[name]]
+        if exceeded:
+            return self._sent(sample, now, exceeded[0])
+        if elapsed >= self.min_interval:
+            return self._sent(sample, now, "heartbeat")
+        return False
+
+    def _sent(self, sample: dict, now: float, reason: str) -> bool:
+        self.last_sent = sample
+        self.last_sent_time = now
+        self.send_reasons[reason] += 1
+        return True
+
+    def report(self) -> None:
+        """Print effective send rate, send reasons and prediction errors, then reset the statistics"""
+        now = time.time()
+        sends = sum(self.send_reasons.values())
+        print("---- FEEDER ADAPTIVE SEND ----")
+        print(f"effective send rate: {sends / max(now - self.report_start_time, 1e-9):.2f} Hz "
+              f"({sends} sent of {self.n_samples} samples checked)")
+        print("send reasons:", dict(self.send_reasons))
+        print("prediction error mean/max:", ", ".join(
+            f"{name} {self.error_sum[name] / max(self.n_samples, 1):.2f}/{self.error_max[name]:.2f}"
+            for name in self.ERRORS
+        ))
+        print("------------------------------")
+        self.send_reasons.clear()
+        self.error_sum = dict.fromkeys(self.ERRORS, 0.0)
+        self.error_max = dict.fromkeys(self.ERRORS, 0.0)
+        self.n_samples = 0
+        self.report_start_time = now
+
+
+def simulate_adaptive_turn(
+    turn_rate_deg_s: float = 3.0, gspd_kts: float = 250.0, duration: float = 60.0
+) -> collections.Counter:
+    """Feed a steady turn sampled at ADAPTIVE_MAX_RATE through AdaptiveSendController and return
+    the send reasons. With the default thresholds a standard rate turn must be sent on heading
+    error, not only by heartbeat.
+    """
+    controller = AdaptiveSendController()
+    dt = 1 / ADAPTIVE_MAX_RATE
+    lat, lon, crs = 59.65, 17.92, 0.0
+    for i in range(int(duration / dt) + 1):
+        sample = {
+            "toa": i * dt, "lat": lat, "lon": lon, "alt": 10000.0, "height": 10000.0, "gspd": gspd_kts,
+            "crs": crs % 360, "v_rate": 0.0, "turn_rate": turn_rate_deg_s * DEG_TO_RAD, "pitch": 0.0, "bank": 0.0,
+        }
+        controller.should_send(sample, i * dt)
+        # fly the arc to the next sample
+        mean_crs = (crs + turn_rate_deg_s * dt / 2) * DEG_TO_RAD
+        distance_m = gspd_kts * KNOTS_TO_METER_PER_SEC * dt
+        lat += distance_m * math.cos(mean_crs) / EARTH_RADIUS_M / DEG_TO_RAD
+        lon += distance_m * math.sin(mean_crs) / (EARTH_RADIUS_M * math.cos(lat * DEG_TO_RAD)) / DEG_TO_RAD
+        crs += turn_rate_deg_s * dt
+    print(f"{turn_rate_deg_s} deg/s turn at {gspd_kts} kts for {duration} s, send reasons:",
+          dict(controller.send_reasons))
+    assert controller.send_reasons["hdg_deg"] > 0, "turn was not sampled on heading error"
+    return controller.send_reasons
+
+
 def user_flight_feeder_main() -> None:
     """main loop"""
 
@@ -139,81 +352,126 @@ def user_flight_feeder_main() -> None:
     # Initialize time.
     last_time = time.time()
 
+    archive = None
+    if ENABLE_ARCHIVE:
+        archive = TrajectoryArchiveWriter(
+            new_session_dir(ARCHIVE_DIR, "user_flight_feeder"),
+            chunk_rows=ARCHIVE_CHUNK_ROWS,
+            flush_interval=ARCHIVE_FLUSH_INTERVAL,
+        )
+
+    ownship_publisher = None
+    if ENABLE_OWNSHIP_CHANNEL:
+        ownship_publisher = OwnshipPublisher(OWNSHIP_SHM_NAME)
+
+    # in adaptive mode MSFS is sampled at the max rate and the controller decides what to send
+    send_controller = None
+    sample_interval = TIME_INTERVAL_USER_FLIGHT_FEEDER
+    if ADAPTIVE_SEND:
+        send_controller = AdaptiveSendController()
+        sample_interval = 1 / ADAPTIVE_MAX_RATE
+    last_report_time = time.time()
+
     # Main loop
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
 
-        while True:
-            if not msfs_is_connected:
-                ac_requests, msfs_is_connected = connect_msfs()
-
-            if SEND_DATA_TO_NARSIM and (not narsim_is_connected):
-                narsim_is_connected = connect_narsim(sock)
-
-            current_time = time.time()
-            if current_time >= last_time + TIME_INTERVAL_USER_FLIGHT_FEEDER:
-                last_time = current_time
-                toa = last_time
-
-                if not msfs_data_stream_is_initialized:
-                    try:
-                        var_finder = {
-                            "lat": ac_requests.find(LAT_VARNAME),
-                            "lon": ac_requests.find(LON_VARNAME),
-                            "alt": ac_requests.find(ALT_VARNAME),
-                            "height": ac_requests.find(HEIGHT_VARNAME),
-                            "gspd": ac_requests.find(GSPD_VARNAME),
-                            "crs": ac_requests.find(CRS_VARNAME),
-                            "v_rate": ac_requests.find(V_RATE_VARNAME),
-                            "turn_rate": ac_requests.find(TURN_RATE_VARNAME),
-                            "long_acc": ac_requests.find(LONG_ACC_VARNAME),
-                            "v_acc": ac_requests.find(V_ACC_VARNAME),
-                            "pitch": ac_requests.find(PITCH_VARNAME),
-                            "bank": ac_requests.find(BANK_VARNAME),
-                            "ssr_c": ac_requests.find(PRESSURE_ALTITUDE_VARNAME),
-                        }
-
-                        msfs_data_stream_is_initialized = True
-                    except (ConnectionError, OSError):
-                        print("Lost connection with MSFS. Unable to send TCP packet.")
-
-                if msfs_data_stream_is_initialized:
-                    try:
-                        translation_dict = {
-                            "callsign": CALLSIGN,
-                            # "toa": toa,
-                            "ssr_a": SQUAWK_OKTAL,
-                            "ssr_c": int(
-                                round(var_finder["ssr_c"].get() * METER_TO_FEET, -2)
-                                / 100
-                            ),
-                            "ssr_s": ICAO_ID,
-                            "lat": var_finder["lat"].get(),
-                            "lon": var_finder["lon"].get(),
-                            "alt": var_finder["alt"].get(),
-                            "height": var_finder["height"].get() * FEET_TO_METER,
-                            "gspd": var_finder["gspd"].get() * KNOTS_TO_METER_PER_SEC,
-                            "crs": var_finder["crs"].get(),
-                            "v_rate": var_finder["v_rate"].get() * FEET_TO_METER,
-                            "turn_rate": var_finder["turn_rate"].get() * DEG_TO_RAD,
-                            "long_acc": var_finder["long_acc"].get(),
-                            "v_acc": var_finder["v_acc"].get(),
-                            "pitch": -var_finder["pitch"].get(),
-                            "bank": var_finder["bank"].get(),
-                        }
-                        xml_output = XML_TEMPLATE_TRUTH.format(**translation_dict)
-                        print(xml_output)
-                        # print(translation_dict["ssr_c"])
-                        # print(translation_dict)
-                        # print()
+        try:
+            while True:
+                if not msfs_is_connected:
+                    ac_requests, msfs_is_connected = connect_msfs()
+
+                if SEND_DATA_TO_NARSIM and (not narsim_is_connected):
+                    narsim_is_connected = connect_narsim(sock)
 
+                current_time = time.time()
+                if current_time >= last_time + sample_interval:
+                    last_time = current_time
+                    toa = last_time
+
+                    if not msfs_data_stream_is_initialized:
+                        try:
+                            var_finder = {
+                                "lat": ac_requests.find(LAT_VARNAME),
+                                "lon": ac_requests.find(LON_VARNAME),
+                                "alt": ac_requests.find(ALT_VARNAME),
+                                "height": ac_requests.find(HEIGHT_VARNAME),
+                                "gspd": ac_requests.find(GSPD_VARNAME),
+                                "crs": ac_requests.find(CRS_VARNAME),
+                                "v_rate": ac_requests.find(V_RATE_VARNAME),
+                                "turn_rate": ac_requests.find(TURN_RATE_VARNAME),
+                                "long_acc": ac_requests.find(LONG_ACC_VARNAME),
+                                "v_acc": ac_requests.find(V_ACC_VARNAME),
+                                "pitch": ac_requests.find(PITCH_VARNAME),
+                                "bank": ac_requests.find(BANK_VARNAME),
+                                "ssr_c": ac_requests.find(PRESSURE_ALTITUDE_VARNAME),
+                            }
+
+                            msfs_data_stream_is_initialized = True
+                        except (ConnectionError, OSError):
+                            print("Lost connection with MSFS. Unable to send TCP packet.")
+
+                    if msfs_data_stream_is_initialized:
                         try:
-                            if SEND_DATA_TO_NARSIM:
-                                sock.send(xml_output.encode())
-                        except socket.error as msg:
-                            print("Lost connection to NARSIM, TCP socket error: " + msg)
-                    except (ConnectionError, OSError):
-                        print("Lost connection with MSFS.")
-            time.sleep(0.10)  # lower load on CPU by not looping unnecessarily much
+                            with tracer.span("sample", callsign=CALLSIGN):
+                                translation_dict = {
+                                    "callsign": CALLSIGN,
+                                    # "toa": toa,
+                                    "ssr_a": SQUAWK_OKTAL,
+                                    "ssr_c": int(
+                                        round(var_finder["ssr_c"].get() * METER_TO_FEET, -2)
+                                        / 100
+                                    ),
+                                    "ssr_s": ICAO_ID,
+                                    "lat": var_finder["lat"].get(),
+                                    "lon": var_finder["lon"].get(),
+                                    "alt": var_finder["alt"].get(),
+                                    "height": var_finder["height"].get() * FEET_TO_METER,
+                                    "gspd": var_finder["gspd"].get() * KNOTS_TO_METER_PER_SEC,
+                                    "crs": var_finder["crs"].get(),
+                                    "v_rate": var_finder["v_rate"].get() * FEET_TO_METER,
+                                    "turn_rate": var_finder["turn_rate"].get() * DEG_TO_RAD,
+                                    "long_acc": var_finder["long_acc"].get(),
+                                    "v_acc": var_finder["v_acc"].get(),
+                                    "pitch": -var_finder["pitch"].get(),
+                                    "bank": var_finder["bank"].get(),
+                                }
+                                if geoid_model is not None:
+                                    translation_dict["height"] = geoid_model.msl_to_ellipsoidal(
+                                        translation_dict["height"], translation_dict["lat"], translation_dict["lon"]
+                                    )
+                            record = ownship_record(translation_dict, toa)
+                            if ownship_publisher is not None:
+                                ownship_publisher.publish(record)
+                            if send_controller is None or send_controller.should_send(record, toa):
+                                with tracer.span("encode", callsign=CALLSIGN):
+                                    xml_output = XML_TEMPLATE_TRUTH.format(**translation_dict)
+                                print(xml_output)
+                                if archive is not None:
+                                    archive.append(CALLSIGN, record, toa)
+                                # print(translation_dict["ssr_c"])
+                                # print(translation_dict)
+                                # print()
+
+                                try:
+                                    if SEND_DATA_TO_NARSIM:
+                                        with tracer.span("send", callsign=CALLSIGN):
+                                            sock.send(xml_output.encode())
+                                except socket.error as msg:
+                                    print("Lost connection to NARSIM, TCP socket error: " + msg)
+                        except (ConnectionError, OSError):
+                            print("Lost connection with MSFS.")
+                if archive is not None:
+                    archive.flush_if_due()
+                if send_controller is not None and current_time >= last_report_time + ADAPTIVE_REPORT_INTERVAL:
+                    last_report_time = current_time
+                    send_controller.report()
+                # lower load on CPU by not looping unnecessarily much
+                time.sleep(min(0.10, sample_interval / 2))
+        finally:
+            if archive is not None:
+                archive.close()
+            if ownship_publisher is not None:
+                ownship_publisher.close()
 
 
 if __name__ == "__main__":